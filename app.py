@@ -13,14 +13,12 @@
 
 import streamlit as st
 from datetime import datetime
+from pathlib import Path
 
 # Core
-from core.data_store import get_store, init_store
+from core.data_store import GeoDataStore, get_store, init_store
 
-# Components
-from components.knowledge_base import render_knowledge_base_panel, render_knowledge_base_sidebar
-from components.geo_viewer import render_geo_viewer
-from components.analysis import render_analysis_panel
+# Components (los paneles de cada pestaña se importan dentro de su bloque)
 from components.chat import render_chat_interface, init_chat_session
 from components.sidebar import render_sidebar
 
@@ -54,127 +52,16 @@ st.set_page_config(
 # ESTILOS CSS
 # ══════════════════════════════════════════════════════════════════════════════
 
-st.markdown("""
-<style>
-    /* Fuentes y colores base */
-    :root {
-        --primary: #1a5f4a;
-        --primary-light: #2d8a6e;
-        --secondary: #0ea5e9;
-        --background: #f8fafc;
-        --card-bg: #ffffff;
-        --text: #1e293b;
-        --text-light: #64748b;
-    }
-    
-    /* Header principal */
-    .main-header {
-        background: linear-gradient(135deg, var(--primary) 0%, var(--primary-light) 100%);
-        padding: 1.5rem 2rem;
-        border-radius: 12px;
-        color: white;
-        margin-bottom: 1.5rem;
-        box-shadow: 0 4px 20px rgba(26, 95, 74, 0.3);
-    }
-    
-    .main-header h1 {
-        margin: 0;
-        font-size: 2rem;
-        font-weight: 700;
-    }
-    
-    .main-header p {
-        margin: 0.5rem 0 0 0;
-        opacity: 0.9;
-        font-size: 1rem;
-    }
-    
-    /* Tabs personalizados */
-    .stTabs [data-baseweb="tab-list"] {
-        gap: 8px;
-        background: var(--background);
-        padding: 0.5rem;
-        border-radius: 12px;
-    }
-    
-    .stTabs [data-baseweb="tab"] {
-        background: var(--card-bg);
-        border-radius: 8px;
-        padding: 0.75rem 1.5rem;
-        font-weight: 500;
-        border: 1px solid #e2e8f0;
-    }
-    
-    .stTabs [aria-selected="true"] {
-        background: linear-gradient(135deg, var(--primary) 0%, var(--primary-light) 100%) !important;
-        color: white !important;
-        border: none;
-    }
-    
-    /* Cards */
-    .geo-card {
-        background: var(--card-bg);
-        padding: 1.5rem;
-        border-radius: 12px;
-        border: 1px solid #e2e8f0;
-        box-shadow: 0 1px 3px rgba(0,0,0,0.05);
-        margin-bottom: 1rem;
-    }
-    
-    /* Badges de estado */
-    .status-badge {
-        display: inline-flex;
-        align-items: center;
-        gap: 6px;
-        padding: 4px 12px;
-        border-radius: 20px;
-        font-size: 0.8rem;
-        font-weight: 500;
-    }
-    
-    .status-connected {
-        background: #dcfce7;
-        color: #166534;
-    }
-    
-    .status-disconnected {
-        background: #fef3c7;
-        color: #92400e;
-    }
-    
-    /* Expanders mejorados */
-    .streamlit-expanderHeader {
-        background: var(--background);
-        border-radius: 8px;
-    }
-    
-    /* Botones primarios */
-    .stButton > button[kind="primary"] {
-        background: linear-gradient(135deg, var(--primary) 0%, var(--primary-light) 100%);
-        border: none;
-        font-weight: 600;
-    }
-    
-    /* Footer */
-    .footer {
-        text-align: center;
-        padding: 1.5rem;
-        color: var(--text-light);
-        font-size: 0.85rem;
-    }
-    
-    /* Ocultar elementos de Streamlit */
-    #MainMenu {visibility: hidden;}
-    footer {visibility: hidden;}
-    
-    /* Responsive */
-    @media (max-width: 768px) {
-        .main-header h1 {
-            font-size: 1.5rem;
-        }
-    }
-</style>
-""", unsafe_allow_html=True)
+CSS_PATH = Path(__file__).parent / "assets" / "styles.css"
+
+
+@st.cache_data(show_spinner=False)
+def load_css(path: str) -> str:
+    """Lee la hoja de estilos una sola vez por proceso y la envuelve en <style>"""
+    return f"<style>\n{Path(path).read_text(encoding='utf-8')}</style>"
+
+
+st.html(load_css(str(CSS_PATH)))
 
 # ══════════════════════════════════════════════════════════════════════════════
 # INICIALIZACIÓN
@@ -199,17 +86,25 @@ with st.sidebar:
 
 store = get_store()
 
-# Header con estado de conexión
-st.markdown("""
+
+@st.cache_data(show_spinner=False, max_entries=64,
+               hash_funcs={GeoDataStore: GeoDataStore.cache_token})
+def cached_summary(store: GeoDataStore) -> dict:
+    """Resumen del store; solo se recalcula cuando cambia su versión"""
+    return store.get_summary()
+
+
+# Header con estado de conexión (HTML puro: st.html no pasa por el parser de markdown)
+st.html("""
 <div class="main-header">
     <h1>🌍 GeoIA Territorial</h1>
     <p>Inteligencia Artificial para Territorios Inteligentes</p>
 </div>
-""", unsafe_allow_html=True)
+""")
 
 # Barra de estado
 if store.is_connected:
-    summary = store.get_summary()
+    summary = cached_summary(store)
     col1, col2, col3, col4 = st.columns(4)
     
     with col1:
@@ -222,50 +117,104 @@ if store.is_connected:
         st.metric("📥 Cargadas", summary['capas_cargadas'])
 
 # ══════════════════════════════════════════════════════════════════════════════
-# TABS PRINCIPALES
+# FRAGMENTOS POR PESTAÑA
 # ══════════════════════════════════════════════════════════════════════════════
+# Cada panel interactivo es un fragmento: sus widgets solo re-ejecutan su propio
+# cuerpo, no el script completo ni las demás pestañas.
+
+@st.fragment
+def chat_fragment(config: dict):
+    render_chat_interface(config)
+
+
+@st.fragment
+def knowledge_base_fragment():
+    from components.knowledge_base import render_knowledge_base_panel
+    render_knowledge_base_panel()
+
+
+@st.fragment
+def geo_viewer_fragment():
+    from components.geo_viewer import render_geo_viewer
+    render_geo_viewer()
+
+
+@st.fragment
+def analysis_fragment():
+    from components.analysis import render_analysis_panel
+    render_analysis_panel()
+
+
+@st.cache_data(ttl=30, show_spinner=False)
+def now_minute() -> str:
+    """
+    Fecha y hora a resolución de minuto para el panel informativo. Con ttl=30
+    puede mostrar el minuto anterior durante, como mucho, 30 s tras el cambio:
+    es solo informativo y así cada rerun no vuelve a leer el reloj ni a formatear.
+    """
+    return datetime.now().strftime("%Y-%m-%d %H:%M")
+
+
+@st.fragment
+def system_info_fragment():
+    with st.expander("🔧 Información del Sistema"):
+        store = get_store()
+        kb_status = "Conectada" if store.is_connected else "No conectada"
+        kb_path = str(store.root_path) if store.is_connected else "N/A"
+        
+        st.code(f"""
+Sistema: GeoIA Territorial v3.0
+Fecha: {now_minute()}
+Base de conocimiento: {kb_status}
+Ruta: {kb_path}
+Capas disponibles: {len(store.layers) if store.is_connected else 0}
+Mensajes en sesión: {len(st.session_state.get('messages', []))}
+        """)
 
-tab_chat, tab_kb, tab_viewer, tab_analysis, tab_docs = st.tabs([
-    "💬 Chat Inteligente",
-    "📁 Base de Conocimiento",
-    "🗺️ Visor Geoespacial",
-    "📊 Análisis Territorial",
-    "📚 Documentación"
-])
 
 # ══════════════════════════════════════════════════════════════════════════════
-# TAB 1: CHAT INTELIGENTE
+# PÁGINAS
 # ══════════════════════════════════════════════════════════════════════════════
+# Con st.navigation solo se ejecuta la página activa; con st.tabs se ejecutaban
+# las cinco en cada rerun aunque cuatro estuvieran ocultas.
+
+# ══════════════════════════════════════════════════════════════════════════════
+# PÁGINA 1: CHAT INTELIGENTE
+# ══════════════════════════════════════════════════════════════════════════════
+
+def chat_page():
+    chat_fragment(config)
 
-with tab_chat:
-    render_chat_interface(config)
 
 # ══════════════════════════════════════════════════════════════════════════════
-# TAB 2: BASE DE CONOCIMIENTO
+# PÁGINA 2: BASE DE CONOCIMIENTO
 # ══════════════════════════════════════════════════════════════════════════════
 
-with tab_kb:
-    render_knowledge_base_panel()
+def knowledge_base_page():
+    knowledge_base_fragment()
+
 
 # ══════════════════════════════════════════════════════════════════════════════
-# TAB 3: VISOR GEOESPACIAL
+# PÁGINA 3: VISOR GEOESPACIAL
 # ══════════════════════════════════════════════════════════════════════════════
 
-with tab_viewer:
-    render_geo_viewer()
+def geo_viewer_page():
+    geo_viewer_fragment()
+
 
 # ══════════════════════════════════════════════════════════════════════════════
-# TAB 4: ANÁLISIS TERRITORIAL
+# PÁGINA 4: ANÁLISIS TERRITORIAL
 # ══════════════════════════════════════════════════════════════════════════════
 
-with tab_analysis:
-    render_analysis_panel()
+def analysis_page():
+    analysis_fragment()
+
 
 # ══════════════════════════════════════════════════════════════════════════════
-# TAB 5: DOCUMENTACIÓN
+# PÁGINA 5: DOCUMENTACIÓN
 # ══════════════════════════════════════════════════════════════════════════════
 
-with tab_docs:
+def docs_page():
     st.markdown("### 📚 Documentación de GeoIA Territorial v3.0")
     
     st.markdown("""
@@ -351,27 +300,30 @@ with tab_docs:
     
     # Info del sistema
     st.markdown("---")
-    with st.expander("🔧 Información del Sistema"):
-        kb_status = "Conectada" if store.is_connected else "No conectada"
-        kb_path = str(store.root_path) if store.is_connected else "N/A"
-        
-        st.code(f"""
-Sistema: GeoIA Territorial v3.0
-Fecha: {datetime.now().strftime("%Y-%m-%d %H:%M")}
-Base de conocimiento: {kb_status}
-Ruta: {kb_path}
-Capas disponibles: {len(store.layers) if store.is_connected else 0}
-Mensajes en sesión: {len(st.session_state.get('messages', []))}
-        """)
+    system_info_fragment()
+
+
+# ══════════════════════════════════════════════════════════════════════════════
+# NAVEGACIÓN
+# ══════════════════════════════════════════════════════════════════════════════
+
+page = st.navigation([
+    st.Page(chat_page, title="Chat Inteligente", icon="💬", default=True),
+    st.Page(knowledge_base_page, title="Base de Conocimiento", icon="📁", url_path="base-conocimiento"),
+    st.Page(geo_viewer_page, title="Visor Geoespacial", icon="🗺️", url_path="visor"),
+    st.Page(analysis_page, title="Análisis Territorial", icon="📊", url_path="analisis"),
+    st.Page(docs_page, title="Documentación", icon="📚", url_path="documentacion"),
+])
+page.run()
 
 # ══════════════════════════════════════════════════════════════════════════════
 # FOOTER
 # ══════════════════════════════════════════════════════════════════════════════
 
 st.markdown("---")
-st.markdown("""
+st.html("""
 <div class="footer">
     <p>🌍 <strong>GeoIA Territorial v3.0</strong> | Desarrollado con ❤️ para territorios inteligentes</p>
     <p style="font-size: 0.75rem; opacity: 0.7;">Powered by Streamlit + Google Gemini + GeoPandas + Folium</p>
 </div>
-""", unsafe_allow_html=True)
+""")
@@ -1,29 +1,39 @@
 """
 GeoIA Territorial v3.0 - Components Package
+
+Los submódulos se importan bajo demanda (PEP 562): acceder a un símbolo
+carga solo el componente que lo define, no geopandas/folium/Gemini de golpe.
 """
 
-from .knowledge_base import (
-    render_knowledge_base_panel,
-    render_knowledge_base_sidebar,
-    get_kb_layers_for_selector,
-    load_kb_layer,
-    get_kb_context_for_chat
-)
-from .geo_viewer import render_geo_viewer
-from .analysis import render_analysis_panel
-from .chat import render_chat_interface, init_chat_session, clear_chat
-from .sidebar import render_sidebar
-
-__all__ = [
-    'render_knowledge_base_panel',
-    'render_knowledge_base_sidebar',
-    'get_kb_layers_for_selector',
-    'load_kb_layer',
-    'get_kb_context_for_chat',
-    'render_geo_viewer',
-    'render_analysis_panel',
-    'render_chat_interface',
-    'init_chat_session',
-    'clear_chat',
-    'render_sidebar'
-]
+import importlib
+
+# Símbolo exportado -> submódulo que lo define
+_EXPORTS = {
+    'render_knowledge_base_panel': 'knowledge_base',
+    'render_knowledge_base_sidebar': 'knowledge_base',
+    'get_kb_layers_for_selector': 'knowledge_base',
+    'load_kb_layer': 'knowledge_base',
+    'get_kb_context_for_chat': 'knowledge_base',
+    'render_geo_viewer': 'geo_viewer',
+    'render_analysis_panel': 'analysis',
+    'render_chat_interface': 'chat',
+    'init_chat_session': 'chat',
+    'clear_chat': 'chat',
+    'render_sidebar': 'sidebar',
+}
+
+__all__ = list(_EXPORTS)
+
+
+def __getattr__(name: str):
+    if name not in _EXPORTS:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+    module = importlib.import_module(f".{_EXPORTS[name]}", __name__)
+    value = getattr(module, name)
+    globals()[name] = value  # Accesos siguientes no pasan por __getattr__
+    return value
+
+
+def __dir__():
+    return sorted(list(globals()) + __all__)
@@ -8,15 +8,24 @@ import streamlit as st
 import geopandas as gpd
 import pandas as pd
 import numpy as np
+import shapely
+import pyogrio
+import io
+import os
+import warnings
+from concurrent.futures import ThreadPoolExecutor
 import folium
+from folium.plugins import FastMarkerCluster, HeatMap
+from branca.colormap import LinearColormap
+from matplotlib import colormaps, colors as mcolors
 from streamlit_folium import st_folium
 from pathlib import Path
 import sys
 
 sys.path.insert(0, str(Path(__file__).parent.parent))
 
-from core.data_store import get_store
-from core.execution_engine import GeoProcessingTools
+from core.data_store import format_count, get_store
+from core.execution_engine import GeoProcessingTools, is_polygonal
 
 
 def render_analysis_panel():
@@ -110,7 +119,7 @@ def render_single_layer_analysis(store, layers: list, analysis_type: str):
             st.markdown(f"""
             **Información:**
             - Geometría: {layer_info['geometry_type']}
-            - Elementos: {layer_info['feature_count']:,}
+            - Elementos: {format_count(layer_info['feature_count'])}
             - CRS: {layer_info['crs'] or 'No definido'}
             """)
         
@@ -132,7 +141,8 @@ def render_single_layer_analysis(store, layers: list, analysis_type: str):
                 elif analysis_type == "convex_hull":
                     result = calculate_convex_hull(gdf)
                 elif analysis_type == "stats":
-                    display_statistics(gdf, selected_layer)
+                    column_types = layer_column_types(store.layer_cache_key(selected_layer), gdf)
+                    display_statistics(gdf, selected_layer, column_types)
                     return
                 
                 if result is not None:
@@ -214,26 +224,21 @@ def render_two_layer_analysis(store, layers: list, analysis_type: str):
         if run_analysis:
             with st.spinner("Procesando capas..."):
                 gdf1 = store.load_layer(layer1)
-                gdf2 = store.load_layer(layer2)
+                
+                # Segunda capa en el CRS de la primera (reproyección cacheada)
+                gdf2 = store.load_layer_as(layer2, gdf1.crs) if gdf1 is not None else None
                 
                 if gdf1 is None or gdf2 is None:
                     st.error("Error al cargar las capas")
                     return
                 
-                # Asegurar mismo CRS
-                if gdf1.crs != gdf2.crs:
-                    gdf2 = gdf2.to_crs(gdf1.crs)
-                
-                if analysis_type == "intersection":
-                    result = gpd.overlay(gdf1, gdf2, how='intersection')
-                elif analysis_type == "union":
-                    result = gpd.overlay(gdf1, gdf2, how='union')
-                elif analysis_type == "difference":
-                    result = gpd.overlay(gdf1, gdf2, how='difference')
-                elif analysis_type == "spatial_join":
-                    result = gpd.sjoin(gdf1, gdf2, how='inner', predicate=predicate)
-                elif analysis_type == "clip":
-                    result = gpd.clip(gdf1, gdf2)
+                result = run_two_layer_analysis(
+                    analysis_type,
+                    store.layer_cache_key(layer1),
+                    store.layer_cache_key(layer2),
+                    predicate if analysis_type == "spatial_join" else None,
+                    gdf1, gdf2
+                )
                 
                 st.success(f"✅ Resultado: {len(result)} elementos")
                 display_result(result, f"{analysis_type.title()}: {layer1} + {layer2}")
@@ -259,7 +264,7 @@ def render_thematic_map(store, layers: list):
             return
         
         # Columnas numéricas para colorear
-        numeric_cols = gdf.select_dtypes(include=[np.number]).columns.tolist()
+        numeric_cols = layer_column_types(store.layer_cache_key(selected_layer), gdf)['numeric']
         
         if numeric_cols:
             color_column = st.selectbox(
@@ -290,10 +295,9 @@ def calculate_areas(gdf: gpd.GeoDataFrame) -> gpd.GeoDataFrame:
     """Calcula áreas en metros cuadrados y hectáreas"""
     result = gdf.copy()
     
-    # Reproyectar si es geográfico
+    # Reproyectar si es geográfico (solo la columna de geometría, no la tabla completa)
     if result.crs and result.crs.is_geographic:
-        result_proj = result.to_crs(result.estimate_utm_crs())
-        result['area_m2'] = result_proj.geometry.area
+        result['area_m2'] = GeoProcessingTools.metric_geometry(gdf).area
     else:
         result['area_m2'] = result.geometry.area
     
@@ -304,38 +308,183 @@ def calculate_areas(gdf: gpd.GeoDataFrame) -> gpd.GeoDataFrame:
 
 
 def calculate_centroids(gdf: gpd.GeoDataFrame) -> gpd.GeoDataFrame:
-    """Calcula centroides de geometrías"""
+    """Calcula centroides de geometrías (ufuncs vectorizadas de Shapely 2)"""
     result = gdf.copy()
-    result['geometry'] = result.geometry.centroid
-    result['centroid_x'] = result.geometry.x
-    result['centroid_y'] = result.geometry.y
+    centroids = shapely.centroid(gdf.geometry.to_numpy())
+    result['geometry'] = centroids
+    result['centroid_x'] = shapely.get_x(centroids)
+    result['centroid_y'] = shapely.get_y(centroids)
     return result
 
 
 def calculate_convex_hull(gdf: gpd.GeoDataFrame) -> gpd.GeoDataFrame:
-    """Calcula envolvente convexa"""
+    """Calcula envolvente convexa (ufunc vectorizada de Shapely 2)"""
     result = gdf.copy()
-    result['geometry'] = result.geometry.convex_hull
+    result['geometry'] = shapely.convex_hull(gdf.geometry.to_numpy())
     return result
 
 
+def prefilter_to_bounds(gdf: gpd.GeoDataFrame, other: gpd.GeoDataFrame) -> gpd.GeoDataFrame:
+    """
+    Descarta los elementos de `gdf` fuera de la extensión de `other`.
+    Para máscaras de clip y capas que se restan: lo que queda fuera no afecta el
+    resultado, y así no entra en la unión de la máscara ni en el índice de overlay.
+    """
+    idx = gdf.sindex.query(shapely.box(*other.total_bounds), predicate='intersects')
+    return gdf.iloc[np.sort(idx)]
+
+
+def calculate_intersection(gdf1: gpd.GeoDataFrame, gdf2: gpd.GeoDataFrame) -> gpd.GeoDataFrame:
+    """Intersección de dos capas (pares del STRtree recortados con Shapely para polígonos)"""
+    return GeoProcessingTools.intersection(gdf1, gdf2)
+
+
+def calculate_union(gdf1: gpd.GeoDataFrame, gdf2: gpd.GeoDataFrame) -> gpd.GeoDataFrame:
+    """
+    Unión de dos capas como intersección + ambas diferencias.
+    Evita la diferencia simétrica de gpd.overlay(how='union'); mismo resultado.
+    """
+    if not (is_polygonal(gdf1) and is_polygonal(gdf2)):
+        return gpd.overlay(gdf1, gdf2, how='union')
+    
+    inter = calculate_intersection(gdf1, gdf2)
+    diff1 = gpd.overlay(gdf1, gdf2, how='difference')
+    diff2 = gpd.overlay(gdf2, gdf1, how='difference')
+    
+    # Mismos sufijos _1/_2 que la intersección para las columnas repetidas
+    shared = gdf1.columns.intersection(gdf2.columns).drop(gdf1.geometry.name, errors='ignore')
+    diff1 = diff1.rename(columns={c: f"{c}_1" for c in shared})
+    diff2 = diff2.rename(columns={c: f"{c}_2" for c in shared})
+    
+    result = pd.concat([inter, diff1, diff2], ignore_index=True)
+    return gpd.GeoDataFrame(result, geometry=result.geometry.name, crs=gdf1.crs)
+
+
+def calculate_spatial_join(left: gpd.GeoDataFrame, right: gpd.GeoDataFrame,
+                           predicate: str = 'intersects') -> gpd.GeoDataFrame:
+    """
+    Join espacial 'inner' con una sola consulta al STRtree de la capa derecha.
+    El STRtree evalúa el predicado con geometrías preparadas; mismas columnas
+    (sufijos _left/_right, index_right) que gpd.sjoin.
+    """
+    idx_left, idx_right = right.sindex.query(left.geometry, predicate=predicate, sort=True)
+    
+    result = left.iloc[idx_left]
+    right_attrs = pd.DataFrame(right.drop(columns=right.geometry.name)).iloc[idx_right]
+    
+    shared = result.columns.intersection(right_attrs.columns)
+    result = result.rename(columns={c: f"{c}_left" for c in shared})
+    right_attrs = right_attrs.rename(columns={c: f"{c}_right" for c in shared})
+    right_attrs.insert(0, 'index_right', right.index[idx_right])
+    right_attrs.index = result.index
+    
+    return pd.concat([result, right_attrs], axis=1)
+
+
+@st.cache_data(show_spinner=False, max_entries=16)
+def run_two_layer_analysis(analysis_type: str, key1: tuple, key2: tuple, predicate: str,
+                           _gdf1: gpd.GeoDataFrame, _gdf2: gpd.GeoDataFrame) -> gpd.GeoDataFrame:
+    """
+    Ejecuta un análisis de dos capas, cacheado por (tipo, capa1, capa2, predicado).
+    Las claves de capa incluyen ruta y versión de archivos: volver a pulsar "Ejecutar" con las
+    mismas entradas no repite el trabajo de GEOS, y editar un archivo lo invalida.
+    """
+    if analysis_type == "intersection":
+        return calculate_intersection(_gdf1, _gdf2)
+    if analysis_type == "union":
+        return calculate_union(_gdf1, _gdf2)
+    if analysis_type == "difference":
+        return gpd.overlay(_gdf1, prefilter_to_bounds(_gdf2, _gdf1), how='difference')
+    if analysis_type == "spatial_join":
+        return calculate_spatial_join(_gdf1, _gdf2, predicate)
+    if analysis_type == "clip":
+        return gpd.clip(_gdf1, prefilter_to_bounds(_gdf2, _gdf1))
+    raise ValueError(f"Análisis desconocido: {analysis_type}")
+
+
+# A partir de este número de geometrías el buffer se reparte entre hilos
+PARALLEL_BUFFER_MIN = 20_000
+
+
+def parallel_buffer(geoms: np.ndarray, distance: float, cap_style: int) -> np.ndarray:
+    """
+    Buffer vectorizado por bloques en un pool de hilos (16 segmentos por
+    cuarto de círculo, como GeoSeries.buffer).
+    Shapely 2 libera el GIL dentro de GEOS, así que los bloques corren en paralelo
+    sin copiar geometrías a otros procesos.
+    """
+    workers = os.cpu_count() or 1
+    if workers == 1 or len(geoms) < PARALLEL_BUFFER_MIN:
+        return shapely.buffer(geoms, distance, quad_segs=16, cap_style=cap_style)
+    
+    chunks = np.array_split(geoms, workers)
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        parts = pool.map(lambda chunk: shapely.buffer(chunk, distance, quad_segs=16, cap_style=cap_style), chunks)
+        return np.concatenate(list(parts))
+
+
 def create_buffer(gdf: gpd.GeoDataFrame, distance: float, cap_style: int) -> gpd.GeoDataFrame:
-    """Crea buffer alrededor de geometrías"""
+    """
+    Crea buffer alrededor de geometrías.
+    Solo se reproyecta y se reconstruye la columna de geometría; los atributos
+    se copian una vez y el buffer corre sobre el array de shapely, sin pasar por
+    el despacho de GeoSeries.
+    """
     result = gdf.copy()
+    geometry = result.geometry
     
     # Reproyectar para trabajar en metros
-    if result.crs and result.crs.is_geographic:
-        original_crs = result.crs
-        result = result.to_crs(result.estimate_utm_crs())
-        result['geometry'] = result.geometry.buffer(distance, cap_style=cap_style)
-        result = result.to_crs(original_crs)
+    if geometry.crs and geometry.crs.is_geographic:
+        metric = GeoProcessingTools.metric_geometry(gdf)
+        buffered = gpd.GeoSeries(
+            parallel_buffer(metric.to_numpy(), distance, cap_style),
+            index=result.index, crs=metric.crs
+        ).to_crs(geometry.crs)
     else:
-        result['geometry'] = result.geometry.buffer(distance, cap_style=cap_style)
+        buffered = gpd.GeoSeries(
+            parallel_buffer(geometry.to_numpy(), distance, cap_style),
+            index=result.index, crs=geometry.crs
+        )
     
+    result[result.geometry.name] = buffered
     return result
 
 
-def display_statistics(gdf: gpd.GeoDataFrame, layer_name: str):
+@st.cache_data(show_spinner=False, max_entries=64)
+def layer_column_types(layer_key: tuple, _gdf: gpd.GeoDataFrame) -> dict:
+    """Columnas numéricas y categóricas de una capa, cacheadas por (capa, ruta, versión)"""
+    return {
+        'numeric': _gdf.select_dtypes(include=[np.number]).columns.tolist(),
+        'categorical': [c for c in _gdf.select_dtypes(include=['object']).columns
+                        if c != _gdf.geometry.name]
+    }
+
+
+def describe_numeric(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Mismas filas que DataFrame.describe(), calculadas con reducciones de numpy
+    sobre una sola matriz float64 en lugar del despacho por columna de pandas.
+    """
+    arr = df.to_numpy(dtype=np.float64, na_value=np.nan)
+    
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", RuntimeWarning)  # Columnas sin valores
+        q25, q50, q75 = np.nanpercentile(arr, [25, 50, 75], axis=0)
+        stats = {
+            'count': np.count_nonzero(~np.isnan(arr), axis=0).astype(np.float64),
+            'mean': np.nanmean(arr, axis=0),
+            'std': np.nanstd(arr, axis=0, ddof=1),
+            'min': np.nanmin(arr, axis=0),
+            '25%': q25,
+            '50%': q50,
+            '75%': q75,
+            'max': np.nanmax(arr, axis=0),
+        }
+    
+    return pd.DataFrame(stats, index=df.columns).T
+
+
+def display_statistics(gdf: gpd.GeoDataFrame, layer_name: str, column_types: dict):
     """Muestra estadísticas descriptivas de la capa"""
     
     st.markdown(f"#### 📊 Estadísticas: {layer_name}")
@@ -347,24 +496,22 @@ def display_statistics(gdf: gpd.GeoDataFrame, layer_name: str):
     with col2:
         st.metric("Columnas", len(gdf.columns) - 1)
     with col3:
-        geom_type = gdf.geometry.geom_type.iloc[0] if len(gdf) > 0 else "N/A"
+        geom_type = gdf.geometry.iloc[:1].geom_type.iloc[0] if len(gdf) > 0 else "N/A"
         st.metric("Geometría", geom_type)
     
     # Estadísticas numéricas
-    numeric_df = gdf.select_dtypes(include=[np.number])
-    
-    if not numeric_df.empty:
+    if column_types['numeric']:
         st.markdown("**Columnas numéricas:**")
-        st.dataframe(numeric_df.describe(), use_container_width=True)
+        st.dataframe(describe_numeric(gdf[column_types['numeric']]), use_container_width=True)
     
     # Columnas categóricas
-    cat_cols = gdf.select_dtypes(include=['object']).columns.tolist()
-    cat_cols = [c for c in cat_cols if c != 'geometry']
+    cat_cols = column_types['categorical']
     
     if cat_cols:
         st.markdown("**Distribución de categorías:**")
         selected_cat = st.selectbox("Columna:", cat_cols)
-        value_counts = gdf[selected_cat].value_counts().head(10)
+        # Top 10 sin ordenar toda la distribución: nlargest es una selección parcial
+        value_counts = gdf[selected_cat].value_counts(sort=False).nlargest(10)
         st.bar_chart(value_counts)
     
     # Bounds geográficos
@@ -378,6 +525,10 @@ Max Y (Norte):  {bounds[3]:.6f}
     """)
 
 
+# Por encima de este número de elementos solo se ofrecen los formatos binarios
+GEOJSON_DOWNLOAD_MAX = 1000
+
+
 def display_result(gdf: gpd.GeoDataFrame, title: str):
     """Muestra resultado de análisis con mapa y tabla"""
     
@@ -401,19 +552,77 @@ def display_result(gdf: gpd.GeoDataFrame, title: str):
     
     with tab_table:
         st.dataframe(
-            gdf.drop(columns='geometry', errors='ignore').head(100),
+            # head() antes de drop(): solo se copian las 100 filas mostradas
+            gdf.head(100).drop(columns='geometry', errors='ignore').convert_dtypes(dtype_backend='pyarrow'),
             use_container_width=True
         )
     
-    # Opción de descarga
-    if st.button("💾 Descargar como GeoJSON"):
-        geojson = gdf.to_json()
+    # Opción de descarga: formatos binarios (GeoParquet, FlatGeobuf); GeoJSON solo para resultados pequeños
+    if st.button("💾 Descargar resultado"):
+        buffer = io.BytesIO()
+        gdf.to_parquet(buffer, compression='zstd')
         st.download_button(
-            "📥 Descargar",
-            data=geojson,
-            file_name="resultado_analisis.geojson",
-            mime="application/json"
+            "📥 Descargar GeoParquet",
+            data=buffer.getvalue(),
+            file_name="resultado_analisis.parquet",
+            mime="application/octet-stream"
         )
+        
+        # FlatGeobuf: binario con índice espacial, se abre directo en QGIS
+        buffer = io.BytesIO()
+        pyogrio.write_dataframe(gdf, buffer, driver='FlatGeobuf')
+        st.download_button(
+            "📥 Descargar FlatGeobuf",
+            data=buffer.getvalue(),
+            file_name="resultado_analisis.fgb",
+            mime="application/octet-stream"
+        )
+        
+        if len(gdf) < GEOJSON_DOWNLOAD_MAX:
+            st.download_button(
+                "📥 Descargar GeoJSON",
+                data=gdf.to_json(),
+                file_name="resultado_analisis.geojson",
+                mime="application/json"
+            )
+
+
+# A partir de este número de elementos los mapas se simplifican para el navegador
+DISPLAY_SIMPLIFY_MIN = 2000
+
+
+def simplify_for_display(gdf: gpd.GeoDataFrame, bounds=None) -> gpd.GeoDataFrame:
+    """
+    Simplifica capas grandes antes de serializarlas a GeoJSON para Folium.
+    La tolerancia es 1/2000 del ancho de la capa: por debajo de un píxel a pantalla completa.
+    `bounds` evita volver a recorrer las coordenadas si el llamador ya las calculó.
+    """
+    if len(gdf) <= DISPLAY_SIMPLIFY_MIN:
+        return gdf
+    
+    if bounds is None:
+        bounds = gdf.total_bounds
+    tolerance = (bounds[2] - bounds[0]) / 2000
+    return gdf.assign(geometry=shapely.simplify(gdf.geometry.to_numpy(), tolerance, preserve_topology=True))
+
+
+def add_display_layer(m: folium.Map, gdf: gpd.GeoDataFrame, style: dict, name: str = None, bounds=None):
+    """
+    Agrega una capa al mapa: los puntos de capas grandes van a un FastMarkerCluster
+    (coordenadas en un solo array JS); el resto, como GeoJSON simplificado.
+    """
+    geoms = gdf.geometry.to_numpy()
+    if len(gdf) > DISPLAY_SIMPLIFY_MIN and (shapely.get_type_id(geoms) == 0).all():
+        coords = np.column_stack([shapely.get_y(geoms), shapely.get_x(geoms)])
+        FastMarkerCluster(coords.tolist(), name=name).add_to(m)
+        return
+    
+    # Se pasa la cadena GeoJSON ya serializada: menos dicts intermedios y sin el campo id
+    folium.GeoJson(
+        simplify_for_display(gdf, bounds).to_json(drop_id=True),
+        name=name,
+        style_function=lambda x: style
+    ).add_to(m)
 
 
 def display_result_with_map(result_gdf: gpd.GeoDataFrame, original_gdf: gpd.GeoDataFrame, title: str):
@@ -434,36 +643,53 @@ def display_result_with_map(result_gdf: gpd.GeoDataFrame, original_gdf: gpd.GeoD
     m.fit_bounds([[bounds[1], bounds[0]], [bounds[3], bounds[2]]])
     
     # Capa original (semi-transparente)
-    folium.GeoJson(
-        original_gdf,
-        name="Original",
-        style_function=lambda x: {
-            'fillColor': '#888888',
-            'color': '#444444',
-            'weight': 1,
-            'fillOpacity': 0.3
-        }
-    ).add_to(m)
+    add_display_layer(m, original_gdf, {
+        'fillColor': '#888888',
+        'color': '#444444',
+        'weight': 1,
+        'fillOpacity': 0.3
+    }, name="Original")
     
     # Resultado
-    folium.GeoJson(
-        result_gdf,
-        name="Resultado",
-        style_function=lambda x: {
-            'fillColor': '#ff7800',
-            'color': '#ff5500',
-            'weight': 2,
-            'fillOpacity': 0.5
-        }
-    ).add_to(m)
+    add_display_layer(m, result_gdf, {
+        'fillColor': '#ff7800',
+        'color': '#ff5500',
+        'weight': 2,
+        'fillOpacity': 0.5
+    }, name="Resultado", bounds=bounds)
     
     folium.LayerControl().add_to(m)
     
-    st_folium(m, width=None, height=400, use_container_width=True)
+    # Mapa solo de visualización: sin returned_objects, mover o hacer zoom no dispara reruns
+    st_folium(m, width=None, height=400, use_container_width=True, returned_objects=[])
+
+
+DISPLAY_SAMPLE_MAX = 5000
+HEATMAP_BINS = 128
+
+
+def density_points(xy: np.ndarray, bins: int = HEATMAP_BINS) -> list:
+    """
+    Agrega puntos (x, y) en una rejilla de bins x bins y devuelve
+    [lat, lon, peso] por celda no vacía, con el peso relativo a la celda más
+    densa: el HeatMap serializa como mucho bins² puntos, no uno por elemento.
+    """
+    
+    counts, x_edges, y_edges = np.histogram2d(xy[:, 0], xy[:, 1], bins=bins)
+    ix, iy = np.nonzero(counts)
+    lon = (x_edges[ix] + x_edges[ix + 1]) / 2
+    lat = (y_edges[iy] + y_edges[iy + 1]) / 2
+    weight = counts[ix, iy] / counts.max()
+    return np.column_stack([lat, lon, weight]).tolist()
 
 
 def display_simple_map(gdf: gpd.GeoDataFrame):
-    """Muestra mapa simple de un GeoDataFrame"""
+    """
+    Muestra mapa simple de un GeoDataFrame.
+    Las capas de líneas o polígonos con más de DISPLAY_SAMPLE_MAX elementos se
+    dibujan con una muestra aleatoria fija y un HeatMap de los centroides de
+    todos los elementos, agregados en rejilla, como contexto de densidad.
+    """
     
     if gdf.crs and gdf.crs != 'EPSG:4326':
         gdf = gdf.to_crs('EPSG:4326')
@@ -474,17 +700,23 @@ def display_simple_map(gdf: gpd.GeoDataFrame):
     m = folium.Map(location=center, tiles='CartoDB positron')
     m.fit_bounds([[bounds[1], bounds[0]], [bounds[3], bounds[2]]])
     
-    folium.GeoJson(
-        gdf,
-        style_function=lambda x: {
-            'fillColor': '#3388ff',
-            'color': '#000000',
-            'weight': 1,
-            'fillOpacity': 0.6
-        }
-    ).add_to(m)
+    geoms = gdf.geometry.to_numpy()
+    if len(gdf) > DISPLAY_SAMPLE_MAX and not (shapely.get_type_id(geoms) == 0).all():
+        xy = shapely.get_coordinates(shapely.centroid(geoms[~shapely.is_empty(geoms)]))
+        if len(xy):
+            HeatMap(density_points(xy), name="Densidad").add_to(m)
+        gdf = gdf.sample(n=DISPLAY_SAMPLE_MAX, random_state=0)
+        st.caption(f"Mostrando una muestra de {DISPLAY_SAMPLE_MAX:,} de {len(geoms):,} elementos "
+                   "sobre un mapa de densidad de la capa completa")
+    
+    add_display_layer(m, gdf, {
+        'fillColor': '#3388ff',
+        'color': '#000000',
+        'weight': 1,
+        'fillOpacity': 0.6
+    }, bounds=bounds)
     
-    st_folium(m, width=None, height=400, use_container_width=True)
+    st_folium(m, width=None, height=400, use_container_width=True, returned_objects=[])
 
 
 def create_thematic_map_display(gdf: gpd.GeoDataFrame, column: str, cmap: str, layer_name: str):
@@ -499,30 +731,44 @@ def create_thematic_map_display(gdf: gpd.GeoDataFrame, column: str, cmap: str, l
     m = folium.Map(location=center, tiles='CartoDB positron')
     m.fit_bounds([[bounds[1], bounds[0]], [bounds[3], bounds[2]]])
     
-    # Mapa coroplético
-    folium.Choropleth(
-        geo_data=gdf.__geo_interface__,
-        data=gdf,
-        columns=[gdf.index.name or gdf.columns[0], column],
-        key_on='feature.properties.' + (gdf.index.name or gdf.columns[0]),
-        fill_color=cmap,
-        fill_opacity=0.7,
-        line_opacity=0.8,
-        legend_name=column,
-        nan_fill_color='gray'
+    # Mapa coroplético: colores por elemento calculados de una vez con la paleta de matplotlib
+    display_gdf = simplify_for_display(gdf[[column, gdf.geometry.name]], bounds)
+    values = display_gdf[column].to_numpy(dtype=np.float64, na_value=np.nan)
+    vmin, vmax = float(np.nanmin(values)), float(np.nanmax(values))
+    palette = colormaps[cmap]
+    
+    rgb = (palette(mcolors.Normalize(vmin, vmax)(values))[:, :3] * 255).round().astype(np.uint32)
+    fill = np.char.mod('#%06x', (rgb[:, 0] << 16) | (rgb[:, 1] << 8) | rgb[:, 2]).astype(object)
+    fill[np.isnan(values)] = 'gray'
+    
+    folium.GeoJson(
+        display_gdf.assign(_color=fill).to_json(drop_id=True),
+        style_function=lambda f: {
+            'fillColor': f['properties']['_color'],
+            'color': '#000000',
+            'weight': 1,
+            'opacity': 0.8,
+            'fillOpacity': 0.7
+        }
     ).add_to(m)
     
+    if vmax > vmin:
+        LinearColormap(
+            [mcolors.to_hex(c) for c in palette(np.linspace(0, 1, 10))],
+            vmin=vmin, vmax=vmax, caption=column
+        ).add_to(m)
+    
     st.markdown(f"#### 🗺️ Mapa Temático: {column}")
     
-    # Estadísticas de la columna
+    # Estadísticas de la columna (sobre el mismo array float64 usado para colorear)
     col1, col2, col3, col4 = st.columns(4)
     with col1:
-        st.metric("Mínimo", f"{gdf[column].min():,.2f}")
+        st.metric("Mínimo", f"{vmin:,.2f}")
     with col2:
-        st.metric("Máximo", f"{gdf[column].max():,.2f}")
+        st.metric("Máximo", f"{vmax:,.2f}")
     with col3:
-        st.metric("Media", f"{gdf[column].mean():,.2f}")
+        st.metric("Media", f"{np.nanmean(values):,.2f}")
     with col4:
-        st.metric("Std Dev", f"{gdf[column].std():,.2f}")
+        st.metric("Std Dev", f"{np.nanstd(values, ddof=1):,.2f}")
     
-    st_folium(m, width=None, height=500, use_container_width=True)
+    st_folium(m, width=None, height=500, use_container_width=True, returned_objects=[])
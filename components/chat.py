@@ -9,10 +9,10 @@ Chat con capacidad de:
 
 import streamlit as st
 import google.generativeai as genai
-from streamlit_folium import st_folium
-import folium
-import geopandas as gpd
 import re
+import json
+import hashlib
+from collections import deque
 from datetime import datetime
 from pathlib import Path
 import sys
@@ -20,9 +20,14 @@ import sys
 sys.path.insert(0, str(Path(__file__).parent.parent))
 
 from core.data_store import get_store
-from core.execution_engine import CodeExecutionEngine, generate_geoprocessing_code
 
 
+# Tope del historial en sesión: los mensajes más antiguos se descartan solos
+MAX_CHAT_MESSAGES = 200
+
+# Bloque ```python de una respuesta del modelo
+CODE_FENCE_RE = re.compile(r'```python\s*(.*?)\s*```', re.DOTALL)
+
 # Prompts del sistema por modo
 SYSTEM_PROMPTS = {
     "general": """Eres GeoIA, un asistente experto en análisis geoespacial y ordenamiento territorial.
@@ -129,7 +134,7 @@ def render_chat_interface(config: dict):
     with col_status:
         if store.is_connected:
             layers_count = len(store.layers)
-            loaded_count = sum(1 for l in store.layers.values() if l.loaded)
+            loaded_count = len(store.loaded_layers)
             st.markdown(f"📁 **{layers_count} capas** disponibles ({loaded_count} cargadas)")
         else:
             st.markdown("⚠️ *Sin base de conocimiento conectada*")
@@ -228,7 +233,7 @@ def process_user_message(user_input: str, config: dict, store):
     
     # Agregar mensaje del usuario
     if "messages" not in st.session_state:
-        st.session_state.messages = []
+        clear_chat()
     
     st.session_state.messages.append({
         "role": "user",
@@ -245,8 +250,11 @@ def process_user_message(user_input: str, config: dict, store):
         with st.spinner("Pensando..."):
             response = generate_response(user_input, config, store)
         
-        # Mostrar respuesta
-        st.markdown(response["content"])
+        # Mostrar respuesta (en streaming si no estaba en caché)
+        if "stream" in response:
+            response = stream_response(response)
+        else:
+            st.markdown(response["content"])
         
         # Si hay código, ejecutarlo
         if response.get("code"):
@@ -256,30 +264,103 @@ def process_user_message(user_input: str, config: dict, store):
         st.session_state.messages.append(response)
 
 
+def build_system_instruction(mode: str, store) -> str:
+    """Prompt del modo + contexto de capas: prefijo estable que va como system_instruction"""
+    parts = [SYSTEM_PROMPTS.get(mode, SYSTEM_PROMPTS["general"])]
+    
+    # Agregar información de capas disponibles
+    if store.is_connected:
+        parts.append("\n\n=== CAPAS DISPONIBLES ===")
+        parts.append(store.get_context_for_chat())
+    
+    return "\n".join(parts)
+
+
+@st.cache_resource(show_spinner=False, max_entries=16)
+def get_model(api_key: str, model_name: str, system_instruction: str,
+              temperature: float) -> genai.GenerativeModel:
+    """
+    Cliente Gemini reutilizado entre reruns: se configura y construye una vez
+    por (API key, modelo, instrucción de sistema, temperatura).
+    """
+    genai.configure(api_key=api_key)
+    return genai.GenerativeModel(
+        model_name,
+        system_instruction=system_instruction,
+        generation_config={
+            "temperature": temperature,
+            "max_output_tokens": 4096
+        }
+    )
+
+
+class ReplyNotCached(Exception):
+    """La respuesta todavía no está en la caché de disco"""
+
+
+@st.cache_data(persist="disk", max_entries=256, show_spinner=False)
+def cached_reply(prompt_digest: str, model_name: str, temperature: float, _text: str = None) -> str:
+    """
+    Respuestas de Gemini cacheadas en disco. La clave es el hash de la instrucción
+    de sistema (modo + capas), el historial y la consulta, más modelo y temperatura.
+    Sin `_text` solo consulta: si no hay entrada lanza ReplyNotCached (las
+    excepciones no se cachean). Con `_text` guarda la respuesta ya transmitida.
+    """
+    if _text is None:
+        raise ReplyNotCached(prompt_digest)
+    return _text
+
+
+def stream_gemini(api_key: str, model_name: str, system_instruction: str,
+                  prompt: str, temperature: float):
+    """Genera el texto de la respuesta por fragmentos a medida que llega de la API"""
+    model = get_model(api_key, model_name, system_instruction, temperature)
+    response = model.generate_content(prompt, stream=True)
+    for chunk in response:
+        yield chunk.text
+
+
+def assistant_message(response_text: str) -> dict:
+    """Mensaje del asistente con el código Python detectado en la respuesta"""
+    result = {
+        "role": "assistant",
+        "content": response_text,
+        "timestamp": datetime.now().isoformat()
+    }
+    
+    # Detectar si hay código Python en la respuesta
+    code_match = CODE_FENCE_RE.search(response_text)
+    if code_match:
+        result["code"] = code_match.group(1)
+    
+    return result
+
+
 def generate_response(user_input: str, config: dict, store) -> dict:
-    """Genera respuesta usando Gemini con contexto de las capas"""
+    """
+    Genera respuesta usando Gemini con contexto de las capas.
+    Si la respuesta está en caché se devuelve completa; si no, el mensaje lleva
+    un generador en "stream" que stream_response muestra y guarda al terminar.
+    """
     
     mode = config.get("mode", "general")
-    system_prompt = SYSTEM_PROMPTS.get(mode, SYSTEM_PROMPTS["general"])
+    system_instruction = build_system_instruction(mode, store)
     
-    # Construir contexto
-    context_parts = [system_prompt]
-    
-    # Agregar información de capas disponibles
-    if store.is_connected:
-        context_parts.append("\n\n=== CAPAS DISPONIBLES ===")
-        context_parts.append(store.get_context_for_chat())
+    # El prompt de cada turno solo lleva historial y consulta
+    context_parts = []
     
     # Historial de conversación
     history = ""
-    for msg in st.session_state.get("messages", [])[-6:]:  # Últimos 6 mensajes
+    messages = st.session_state.get("messages", [])
+    for i in range(-min(len(messages), 6), 0):  # Últimos 6 mensajes (índices O(1) en deque)
+        msg = messages[i]
         role = "Usuario" if msg["role"] == "user" else "Asistente"
         history += f"\n{role}: {msg['content'][:500]}"
     
     if history:
-        context_parts.append(f"\n\n=== HISTORIAL RECIENTE ==={history}")
+        context_parts.append(f"=== HISTORIAL RECIENTE ==={history}")
     
-    # Construir prompt completo
+    # Construir prompt del turno
     full_prompt = "\n".join(context_parts) + f"\n\nUsuario: {user_input}\n\nAsistente:"
     
     try:
@@ -293,60 +374,83 @@ def generate_response(user_input: str, config: dict, store) -> dict:
                 "timestamp": datetime.now().isoformat()
             }
         
-        genai.configure(api_key=api_key)
+        model_name = config.get("model", "gemini-2.0-flash")
+        temperature = config.get("temperature", 0.7)
+        prompt_digest = hashlib.blake2b(
+            f"{system_instruction}\x00{full_prompt}".encode("utf-8"), digest_size=16
+        ).hexdigest()
         
-        model = genai.GenerativeModel(
-            config.get("model", "gemini-2.0-flash"),
-            generation_config={
-                "temperature": config.get("temperature", 0.7),
-                "max_output_tokens": 4096
+        try:
+            return assistant_message(cached_reply(prompt_digest, model_name, temperature))
+        except ReplyNotCached:
+            return {
+                "role": "assistant",
+                "stream": stream_gemini(api_key, model_name, system_instruction, full_prompt, temperature),
+                "cache_key": (prompt_digest, model_name, temperature)
             }
-        )
-        
-        response = model.generate_content(full_prompt)
-        response_text = response.text
-        
-        # Detectar si hay código Python en la respuesta
-        code_match = re.search(r'```python\s*(.*?)\s*```', response_text, re.DOTALL)
         
-        result = {
+    except Exception as e:
+        return {
             "role": "assistant",
-            "content": response_text,
+            "content": f"❌ Error al generar respuesta: {str(e)}",
             "timestamp": datetime.now().isoformat()
         }
-        
-        if code_match:
-            result["code"] = code_match.group(1)
-        
-        return result
-        
+
+
+def stream_response(response: dict) -> dict:
+    """Muestra la respuesta a medida que llega y la guarda en la caché al completarse"""
+    try:
+        response_text = st.write_stream(response["stream"])
     except Exception as e:
+        error = f"❌ Error al generar respuesta: {str(e)}"
+        st.markdown(error)
         return {
             "role": "assistant",
-            "content": f"❌ Error al generar respuesta: {str(e)}",
+            "content": error,
             "timestamp": datetime.now().isoformat()
         }
+    
+    cached_reply(*response["cache_key"], _text=response_text)
+    return assistant_message(response_text)
+
+
+@st.cache_data(persist="disk", max_entries=128, show_spinner=False)
+def run_generated_code(code_digest: str, layers_key: tuple, _code: str, _store) -> dict:
+    """
+    Ejecuta código generado por el chat y cachea el resultado en disco.
+    La clave es el hash del código y la versión (ruta, versión de archivos) de cada capa:
+    la misma consulta sobre los mismos datos no se vuelve a ejecutar.
+    """
+    # Al proceso aislado solo viajan las rutas: lee del disco únicamente las
+    # capas que el código usa, sin copiar (pickle) todas las del store
+    from core.execution_engine import CodeExecutionEngine
+    from core.layer_io import LayerFiles
+    layers = LayerFiles({name: str(layer.path) for name, layer in _store.layers.items()})
+    
+    # Crear motor de ejecución y ejecutar en un proceso aparte; el resultado
+    # llega ya serializable (mapas como HTML)
+    engine = CodeExecutionEngine(layers)
+    return engine.execute_isolated(_code)
 
 
 def execute_and_display_code(code: str, store):
     """Ejecuta código GeoPandas y muestra resultados"""
+    # El motor (matplotlib, folium) y geopandas se cargan solo al ejecutar código
+    import geopandas as gpd
+    from core.execution_engine import ExecutionAborted
     
     with st.expander("📝 Código ejecutado", expanded=True):
         st.code(code, language="python")
     
-    # Cargar todas las capas necesarias
-    layers = {}
-    for name in store.layers:
-        gdf = store.load_layer(name)
-        if gdf is not None:
-            layers[name] = gdf
-    
-    # Crear motor de ejecución
-    engine = CodeExecutionEngine(layers)
+    code_digest = hashlib.blake2b(code.encode("utf-8"), digest_size=16).hexdigest()
+    layers_key = tuple(store.layer_cache_key(name) for name in store.layers)
     
-    # Ejecutar código
+    # Ejecutar código (las interrupciones por tiempo o memoria no se cachean)
     with st.spinner("Ejecutando código..."):
-        result = engine.execute(code)
+        try:
+            result = run_generated_code(code_digest, layers_key, code, store)
+        except ExecutionAborted as e:
+            result = {"success": False, "error": str(e)}
     
     if result["success"]:
         # Mostrar output de print()
@@ -357,23 +461,21 @@ def execute_and_display_code(code: str, store):
         # Mostrar mapas generados
         if result["maps"]:
             st.markdown("**🗺️ Mapa generado:**")
-            for i, m in enumerate(result["maps"]):
-                # Renderizar mapa Folium
-                map_html = m._repr_html_()
+            for map_html in result["maps"]:
                 st.components.v1.html(map_html, height=450)
         
         # Mostrar resultado si es DataFrame/GeoDataFrame
-        if result["result"] is not None:
+        if result["result_map_html"]:
+            st.markdown("**🗺️ Mapa:**")
+            st.components.v1.html(result["result_map_html"], height=450)
+        
+        elif result["result"] is not None:
             if isinstance(result["result"], (gpd.GeoDataFrame, )):
                 st.markdown("**📊 Resultado (GeoDataFrame):**")
-                display_df = result["result"].drop(columns='geometry', errors='ignore')
-                st.dataframe(display_df.head(20), use_container_width=True)
+                display_df = result["result"].head(20).drop(columns='geometry', errors='ignore')
+                st.dataframe(display_df, use_container_width=True)
                 st.caption(f"Mostrando 20 de {len(result['result'])} filas")
             
-            elif isinstance(result["result"], folium.Map):
-                st.markdown("**🗺️ Mapa:**")
-                st.components.v1.html(result["result"]._repr_html_(), height=450)
-            
             elif hasattr(result["result"], '__iter__') and not isinstance(result["result"], str):
                 st.markdown("**Resultado:**")
                 st.write(result["result"])
@@ -390,22 +492,20 @@ def execute_and_display_code(code: str, store):
 def init_chat_session():
     """Inicializa la sesión del chat"""
     if "messages" not in st.session_state:
-        st.session_state.messages = []
+        clear_chat()
     
     if "pending_message" not in st.session_state:
         st.session_state.pending_message = None
 
 
 def clear_chat():
-    """Limpia el historial del chat"""
-    st.session_state.messages = []
+    """Limpia el historial del chat (deque acotada a MAX_CHAT_MESSAGES)"""
+    st.session_state.messages = deque(maxlen=MAX_CHAT_MESSAGES)
 
 
 def export_chat():
     """Exporta el historial del chat"""
-    import json
-    
-    messages = st.session_state.get("messages", [])
+    messages = list(st.session_state.get("messages", []))
     
     export_data = {
         "timestamp": datetime.now().isoformat(),
@@ -7,15 +7,20 @@ Permite visualización interactiva con múltiples capas.
 
 import streamlit as st
 import folium
-from folium.plugins import MarkerCluster, Fullscreen, MiniMap, MousePosition
-from streamlit_folium import st_folium
+import json
+import os
+import tempfile
+import zipfile
+from folium.plugins import FastMarkerCluster, Fullscreen, MiniMap, MousePosition
 import geopandas as gpd
+import numpy as np
+import shapely
 from pathlib import Path
 import sys
 
 sys.path.insert(0, str(Path(__file__).parent.parent))
 
-from core.data_store import get_store
+from core.data_store import GeoDataStore, format_count, get_store
 
 
 # Paletas de colores para capas
@@ -36,6 +41,13 @@ BASEMAPS = {
 }
 
 
+@st.cache_data(show_spinner=False, max_entries=32,
+               hash_funcs={GeoDataStore: GeoDataStore.cache_token})
+def cached_layers_info(store: GeoDataStore) -> list:
+    """Metadatos de las capas; solo se recalculan cuando cambia el store"""
+    return store.get_all_layers_info()
+
+
 def render_geo_viewer():
     """
     Renderiza el Visor Geoespacial.
@@ -75,7 +87,7 @@ def render_geo_viewer():
     with col_layers:
         st.markdown("#### 📋 Capas Disponibles")
         
-        available_layers = store.get_all_layers_info()
+        available_layers = cached_layers_info(store)
         
         if not available_layers:
             st.info("No hay capas en la base de conocimiento")
@@ -97,7 +109,7 @@ def render_geo_viewer():
                     f"📍 {layer_name}",
                     value=False,
                     key=f"layer_check_{layer_name}",
-                    help=f"{layer_info['geometry_type']} - {layer_info['feature_count']} elementos"
+                    help=f"{layer_info['geometry_type']} - {format_count(layer_info['feature_count'])} elementos"
                 )
             
             with col_color:
@@ -119,7 +131,7 @@ def render_geo_viewer():
             
             # Info compacta
             if is_selected:
-                st.caption(f"  ↳ {layer_info['feature_count']:,} elementos | {layer_info['crs'] or 'Sin CRS'}")
+                st.caption(f"  ↳ {format_count(layer_info['feature_count'])} elementos | {layer_info['crs'] or 'Sin CRS'}")
         
         st.markdown("---")
         
@@ -150,12 +162,7 @@ def render_geo_viewer():
             st.info("👆 Selecciona capas del panel izquierdo para visualizarlas")
             
             # Mostrar mapa vacío centrado en Colombia
-            empty_map = folium.Map(
-                location=[4.5709, -74.2973],
-                zoom_start=5,
-                tiles=BASEMAPS[basemap]
-            )
-            st_folium(empty_map, width=None, height=600, use_container_width=True)
+            st.components.v1.html(empty_map_html(BASEMAPS[basemap]), height=600)
         else:
             # Cargar y renderizar capas seleccionadas
             render_multi_layer_map(
@@ -168,53 +175,153 @@ def render_geo_viewer():
             )
 
 
+@st.cache_data(show_spinner=False, max_entries=8)
+def empty_map_html(tiles: str) -> str:
+    """
+    Mapa vacío centrado en Colombia. Folium genera ids nuevos en cada render,
+    así que se cachea el HTML: con el mismo mapa base el iframe no se vuelve a montar.
+    """
+    empty_map = folium.Map(
+        location=[4.5709, -74.2973],
+        zoom_start=5,
+        tiles=tiles
+    )
+    return empty_map.get_root().render()
+
+
 def render_multi_layer_map(store, layer_names: list, styles: dict, 
                            basemap: str, show_legend: bool, show_popup: bool):
     """
     Renderiza mapa con múltiples capas de la base de conocimiento.
+    El HTML del mapa se comparte entre reruns y sesiones mientras no cambien
+    los archivos (versión) ni el estilo.
     """
-    # Cargar las capas seleccionadas
+    # Las capas se cargan aquí, en la sesión que las pide, y no dentro del
+    # mapa cacheado (compartido entre sesiones); la reproyección ya queda
+    # cacheada por archivo, así que en los reruns esto es casi gratis
+    if any(name not in store.loaded_layers for name in layer_names):
+        with st.spinner("Cargando capas..."):
+            store.prefetch_layers(layer_names)
     gdfs = {}
-    all_bounds = []
-    
-    progress = st.progress(0)
-    for i, name in enumerate(layer_names):
-        gdf = store.load_layer(name)
+    for name in layer_names:
+        gdf = store.load_layer_wgs84(name)
         if gdf is not None:
-            # Asegurar WGS84
-            if gdf.crs and gdf.crs != 'EPSG:4326':
-                gdf = gdf.to_crs('EPSG:4326')
             gdfs[name] = gdf
-            all_bounds.append(gdf.total_bounds)
-        progress.progress((i + 1) / len(layer_names))
     
-    progress.empty()
+    layer_key = tuple(store.layer_cache_key(name) for name in gdfs)
+    style_key = tuple(
+        (name, tuple(sorted(styles.get(name, {}).items()))) for name in gdfs
+    )
     
-    if not gdfs:
+    map_html, layer_stats = render_map_html(
+        layer_key, style_key, basemap, show_legend, show_popup, gdfs
+    )
+    
+    if map_html is None:
         st.error("No se pudieron cargar las capas seleccionadas")
         return
     
-    # Calcular bounds combinados
-    import numpy as np
-    combined_bounds = [
-        min(b[0] for b in all_bounds),  # minx
-        min(b[1] for b in all_bounds),  # miny
-        max(b[2] for b in all_bounds),  # maxx
-        max(b[3] for b in all_bounds),  # maxy
+    # Renderizar mapa
+    st.components.v1.html(map_html, height=600)
+    
+    # Información de capas cargadas
+    st.markdown("---")
+    cols = st.columns(len(layer_stats))
+    for i, (name, count, geom_type) in enumerate(layer_stats):
+        with cols[i]:
+            st.metric(
+                name,
+                f"{count:,}",
+                help=f"Tipo: {geom_type}"
+            )
+
+
+@st.cache_resource(show_spinner="Construyendo mapa...", max_entries=32)
+def render_map_html(layer_key: tuple, style_key: tuple, basemap: str,
+                    show_legend: bool, show_popup: bool, _gdfs: dict) -> tuple:
+    """
+    Construye el mapa Folium y devuelve (html, [(capa, elementos, geometría)]).
+    `_gdfs` son las capas ya cargadas en WGS84 y no entra en la clave: la
+    identidad de cada capa la da `layer_key` (nombre, ruta, versión). Solo se
+    ejecuta cuando cambia alguna capa, estilo u opción del mapa.
+    """
+    if not _gdfs:
+        return None, []
+    
+    styles = {name: dict(items) for name, items in style_key}
+    layer_keys = {key[0]: key for key in layer_key}
+    m = build_multi_layer_map(_gdfs, styles, basemap, show_legend, show_popup, layer_keys)
+    layer_stats = [
+        (name, len(gdf), gdf.geometry.iloc[:1].geom_type.iloc[0] if len(gdf) > 0 else None)
+        for name, gdf in _gdfs.items()
     ]
+    return m.get_root().render(), layer_stats
+
+
+# Por encima de este número de vértices las capas se simplifican para el navegador
+SIMPLIFY_COORDS_MIN = 50_000
+
+
+def simplify_to_extent(gdf: gpd.GeoDataFrame, extent_width: float) -> gpd.GeoDataFrame:
+    """
+    Douglas-Peucker con tolerancia de ~1 píxel: 1/2000 del ancho del mapa.
+    Solo se aplica a capas de más de SIMPLIFY_COORDS_MIN vértices; el resto
+    se devuelve sin tocar.
+    """
+    geoms = gdf.geometry.to_numpy()
+    if shapely.get_num_coordinates(geoms).sum() <= SIMPLIFY_COORDS_MIN or extent_width <= 0:
+        return gdf
+    return gdf.assign(**{gdf.geometry.name: shapely.simplify(
+        geoms, extent_width / 2000, preserve_topology=False
+    )})
+
+
+@st.cache_data(show_spinner=False, max_entries=64)
+def layer_geojson(layer_key: tuple, popup_cols: tuple, _gdf: gpd.GeoDataFrame) -> str:
+    """
+    GeoJSON serializado de una capa (campos del popup + geometría, simplificada
+    si hace falta), cacheado por (capa, ruta, versión): cambiar el estilo o la
+    selección de capas no vuelve a serializar las que no cambiaron. Por eso la
+    tolerancia sale de la extensión de la propia capa y no de la del mapa.
+    """
+    bounds = _gdf.total_bounds
+    return simplify_to_extent(
+        _gdf[list(popup_cols) + [_gdf.geometry.name]], bounds[2] - bounds[0]
+    ).to_json(drop_id=True)
+
+
+# A partir de este número de elementos en alguna capa, Leaflet dibuja en un
+# único <canvas> en lugar de un nodo SVG por geometría
+CANVAS_RENDER_MIN = 5000
+
+
+def build_multi_layer_map(gdfs: dict, styles: dict, basemap: str,
+                          show_legend: bool, show_popup: bool, layer_keys: dict) -> folium.Map:
+    """
+    Construye el mapa Folium con las capas ya cargadas en WGS84.
+    `layer_keys` asocia cada capa con su clave de caché (nombre, ruta, versión).
+    """
+    prefer_canvas = any(len(gdf) > CANVAS_RENDER_MIN for gdf in gdfs.values())
+    all_bounds = np.array([gdf.total_bounds for gdf in gdfs.values()])
+    
+    # Calcular bounds combinados (minx, miny, maxx, maxy)
+    combined_bounds = np.concatenate([
+        np.nanmin(all_bounds[:, :2], axis=0),
+        np.nanmax(all_bounds[:, 2:], axis=0),
+    ]).tolist()
     center = [(combined_bounds[1] + combined_bounds[3]) / 2,
               (combined_bounds[0] + combined_bounds[2]) / 2]
     
     # Crear mapa
     if basemap.startswith('http'):
-        m = folium.Map(location=center, zoom_start=10, tiles=None)
+        m = folium.Map(location=center, zoom_start=10, tiles=None, prefer_canvas=prefer_canvas)
         folium.TileLayer(
             tiles=basemap,
             attr='ESRI',
             name='ESRI'
         ).add_to(m)
     else:
-        m = folium.Map(location=center, zoom_start=10, tiles=basemap)
+        m = folium.Map(location=center, zoom_start=10, tiles=basemap, prefer_canvas=prefer_canvas)
     
     # Ajustar a bounds
     m.fit_bounds([
@@ -230,26 +337,31 @@ def render_multi_layer_map(store, layer_names: list, styles: dict,
         fg = folium.FeatureGroup(name=name)
         
         # Determinar tipo de geometría
-        geom_type = gdf.geometry.geom_type.iloc[0] if len(gdf) > 0 else None
+        geom_type = gdf.geometry.iloc[:1].geom_type.iloc[0] if len(gdf) > 0 else None
         
         if geom_type in ['Point', 'MultiPoint']:
-            # Puntos con marcadores
-            for idx, row in gdf.iterrows():
-                popup_content = create_popup_content(row, gdf.columns) if show_popup else None
-                
-                folium.CircleMarker(
-                    location=[row.geometry.y, row.geometry.x],
-                    radius=6,
-                    color=style['color'],
-                    fill=True,
-                    fillColor=style['color'],
-                    fillOpacity=0.7,
-                    popup=popup_content
-                ).add_to(fg)
+            # Puntos: coordenadas y atributos se extraen de una vez y viajan como
+            # un solo array JS; el cluster crea los marcadores en el navegador
+            # (las partes de un MultiPoint comparten el popup de su fila)
+            parts, row_index = shapely.get_parts(gdf.geometry.to_numpy(), return_index=True)
+            non_empty = ~shapely.is_empty(parts)
+            parts, row_index = parts[non_empty], row_index[non_empty]
+            ys = shapely.get_y(parts).tolist()
+            xs = shapely.get_x(parts).tolist()
+            
+            if show_popup:
+                popups = create_popups(gdf)
+                data = [[y, x, popups[i]] for x, y, i in zip(xs, ys, row_index.tolist())]
+            else:
+                data = [[y, x] for x, y in zip(xs, ys)]
+            
+            FastMarkerCluster(data, callback=point_marker_callback(style['color'])).add_to(fg)
         else:
-            # Polígonos y líneas
+            # Polígonos y líneas: solo viajan al navegador la geometría y los
+            # campos del popup
+            popup_cols = list(gdf.columns.drop(gdf.geometry.name))[:5] if show_popup else []
             folium.GeoJson(
-                gdf,
+                layer_geojson(layer_keys[name], tuple(popup_cols), gdf),
                 name=name,
                 style_function=lambda x, s=style: {
                     'fillColor': s['color'],
@@ -258,10 +370,10 @@ def render_multi_layer_map(store, layer_names: list, styles: dict,
                     'fillOpacity': s['fillOpacity']
                 },
                 popup=folium.GeoJsonPopup(
-                    fields=list(gdf.columns.drop('geometry'))[:5],
-                    aliases=list(gdf.columns.drop('geometry'))[:5],
+                    fields=popup_cols,
+                    aliases=popup_cols,
                     localize=True
-                ) if show_popup else None
+                ) if popup_cols else None
             ).add_to(fg)
         
         fg.add_to(m)
@@ -277,31 +389,35 @@ def render_multi_layer_map(store, layer_names: list, styles: dict,
         legend_html = create_legend_html(gdfs.keys(), styles)
         m.get_root().html.add_child(folium.Element(legend_html))
     
-    # Renderizar mapa
-    map_data = st_folium(m, width=None, height=600, use_container_width=True)
-    
-    # Información de capas cargadas
-    st.markdown("---")
-    cols = st.columns(len(gdfs))
-    for i, (name, gdf) in enumerate(gdfs.items()):
-        with cols[i]:
-            st.metric(
-                name,
-                f"{len(gdf):,}",
-                help=f"Tipo: {gdf.geometry.geom_type.iloc[0]}"
-            )
+    return m
 
 
-def create_popup_content(row, columns) -> str:
-    """Crea contenido HTML para popup"""
-    content = "<div style='font-size:12px;'>"
-    for col in columns:
-        if col != 'geometry':
-            val = row[col]
-            if val is not None:
-                content += f"<b>{col}:</b> {val}<br>"
-    content += "</div>"
-    return folium.Popup(content, max_width=300)
+def create_popups(gdf: gpd.GeoDataFrame) -> list:
+    """Contenido HTML del popup de cada fila, a partir de una sola extracción de atributos"""
+    return [
+        "<div style='font-size:12px;'>"
+        + "".join(f"<b>{col}:</b> {val}<br>" for col, val in record.items() if val is not None)
+        + "</div>"
+        for record in gdf.drop(columns=gdf.geometry.name).to_dict('records')
+    ]
+
+
+def point_marker_callback(color: str) -> str:
+    """
+    Callback JS de FastMarkerCluster: un circleMarker por fila [lat, lon, popup?];
+    el popup solo se enlaza si la fila lo trae y se abre al hacer clic.
+    """
+    color = json.dumps(color)
+    return f"""
+    function (row) {{
+        var marker = L.circleMarker(new L.LatLng(row[0], row[1]), {{
+            radius: 6, color: {color}, fill: true, fillColor: {color}, fillOpacity: 0.7
+        }});
+        if (row.length > 2) {{
+            marker.bindPopup(row[2], {{maxWidth: 300}});
+        }}
+        return marker;
+    }}"""
 
 
 def create_legend_html(layer_names, styles) -> str:
@@ -334,70 +450,78 @@ def create_legend_html(layer_names, styles) -> str:
     """
 
 
-def render_single_file_map(uploaded_file):
-    """Renderiza mapa de un archivo individual cargado"""
-    import tempfile
-    import os
+@st.cache_data(show_spinner="Leyendo archivo...", max_entries=4)
+def load_uploaded_file(file_id: str, name: str, _data: bytes) -> tuple:
+    """
+    Lee un archivo subido y construye su mapa. Devuelve (GeoDataFrame en WGS84,
+    HTML del mapa), cacheado por el file_id de Streamlit: los reruns del visor
+    no vuelven a leer el archivo ni a regenerar el mapa.
+    """
+    # Guardar archivo temporal
+    suffix = Path(name).suffix
+    
+    with tempfile.NamedTemporaryFile(delete=False, suffix=suffix) as tmp:
+        tmp.write(_data)
+        tmp_path = tmp.name
     
     try:
-        # Guardar archivo temporal
-        suffix = Path(uploaded_file.name).suffix
-        
-        with tempfile.NamedTemporaryFile(delete=False, suffix=suffix) as tmp:
-            tmp.write(uploaded_file.getvalue())
-            tmp_path = tmp.name
-        
-        # Si es ZIP (shapefile), extraer
+        # Si es ZIP (shapefile), GDAL lo lee directamente sin extraerlo
         if suffix.lower() == '.zip':
-            import zipfile
-            extract_dir = tempfile.mkdtemp()
             with zipfile.ZipFile(tmp_path, 'r') as zip_ref:
-                zip_ref.extractall(extract_dir)
+                shp_files = [n for n in zip_ref.namelist() if n.lower().endswith('.shp')]
             
-            # Buscar .shp
-            shp_files = list(Path(extract_dir).rglob('*.shp'))
-            if shp_files:
-                gdf = gpd.read_file(shp_files[0])
-            else:
-                st.error("No se encontró archivo .shp en el ZIP")
-                return
+            if not shp_files:
+                raise ValueError("No se encontró archivo .shp en el ZIP")
+            gdf = gpd.read_file(f"/vsizip/{tmp_path}/{shp_files[0]}", engine="pyogrio")
         else:
-            gdf = gpd.read_file(tmp_path)
-        
+            gdf = gpd.read_file(tmp_path, engine="pyogrio")
+    finally:
         # Limpiar
         os.unlink(tmp_path)
-        
-        # Convertir a WGS84
-        if gdf.crs and gdf.crs != 'EPSG:4326':
-            gdf = gdf.to_crs('EPSG:4326')
+    
+    # Convertir a WGS84
+    if gdf.crs and gdf.crs != 'EPSG:4326':
+        gdf = gdf.to_crs('EPSG:4326')
+    
+    # Crear mapa
+    bounds = gdf.total_bounds
+    center = [(bounds[1] + bounds[3]) / 2, (bounds[0] + bounds[2]) / 2]
+    
+    m = folium.Map(location=center, tiles='CartoDB positron')
+    m.fit_bounds([[bounds[1], bounds[0]], [bounds[3], bounds[2]]])
+    
+    # Sin popup: basta con la geometría
+    folium.GeoJson(
+        simplify_to_extent(gdf[[gdf.geometry.name]], bounds[2] - bounds[0]).to_json(drop_id=True),
+        style_function=lambda x: {
+            'fillColor': '#3388ff',
+            'color': '#000000',
+            'weight': 1,
+            'fillOpacity': 0.6
+        }
+    ).add_to(m)
+    
+    return gdf, m.get_root().render()
+
+
+def render_single_file_map(uploaded_file):
+    """Renderiza mapa de un archivo individual cargado"""
+    try:
+        gdf, map_html = load_uploaded_file(
+            uploaded_file.file_id, uploaded_file.name, uploaded_file.getvalue()
+        )
         
         # Info del archivo
         col1, col2, col3 = st.columns(3)
         with col1:
             st.metric("Elementos", len(gdf))
         with col2:
-            st.metric("Geometría", gdf.geometry.geom_type.iloc[0])
+            st.metric("Geometría", gdf.geometry.iloc[:1].geom_type.iloc[0])
         with col3:
             st.metric("Columnas", len(gdf.columns) - 1)
         
-        # Crear mapa
-        bounds = gdf.total_bounds
-        center = [(bounds[1] + bounds[3]) / 2, (bounds[0] + bounds[2]) / 2]
-        
-        m = folium.Map(location=center, tiles='CartoDB positron')
-        m.fit_bounds([[bounds[1], bounds[0]], [bounds[3], bounds[2]]])
-        
-        folium.GeoJson(
-            gdf,
-            style_function=lambda x: {
-                'fillColor': '#3388ff',
-                'color': '#000000',
-                'weight': 1,
-                'fillOpacity': 0.6
-            }
-        ).add_to(m)
-        
-        st_folium(m, width=None, height=500, use_container_width=True)
+        # HTML idéntico entre reruns: el iframe no se vuelve a montar
+        st.components.v1.html(map_html, height=500)
         
         # Tabla de atributos
         with st.expander("📊 Ver tabla de atributos"):
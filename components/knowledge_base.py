@@ -6,13 +6,14 @@ Panel para conectar carpeta y sincronizar con todos los módulos.
 
 import streamlit as st
 from pathlib import Path
+from string import Template
 from typing import Optional
 import sys
 
 # Agregar path del core
 sys.path.insert(0, str(Path(__file__).parent.parent))
 
-from core.data_store import get_store
+from core.data_store import format_count, get_store
 
 
 def render_knowledge_base_panel():
@@ -138,43 +139,103 @@ def render_knowledge_base_panel():
                 st.warning("Por favor ingresa una ruta de carpeta")
 
 
+EXPLORER_PAGE_SIZE = 25  # Expanders por página en los exploradores
+
+
+def filter_explorer_items(items: dict, key: str, get_format) -> list:
+    """
+    Filtra por nombre y formato los elementos de un explorador. Los filtros
+    solo aparecen cuando hay más de una página de elementos.
+    """
+    if len(items) <= EXPLORER_PAGE_SIZE:
+        return list(items.items())
+    
+    col_query, col_format = st.columns([2, 1])
+    with col_query:
+        query = st.text_input(
+            "🔎 Filtrar por nombre", key=f"{key}_query",
+            on_change=reset_explorer_page, args=(key,)
+        ).strip().lower()
+    with col_format:
+        formats = sorted({get_format(item) for item in items.values()})
+        format_filter = st.selectbox(
+            "Formato", ["Todos", *formats], key=f"{key}_format",
+            on_change=reset_explorer_page, args=(key,)
+        )
+    
+    return [
+        (name, item) for name, item in items.items()
+        if query in name.lower() and format_filter in ("Todos", get_format(item))
+    ]
+
+
+def reset_explorer_page(key: str):
+    """Vuelve a la primera página: un filtro nuevo no hereda las páginas ya mostradas"""
+    st.session_state[f"{key}_shown"] = EXPLORER_PAGE_SIZE
+
+
+def page_explorer_items(matches: list, key: str):
+    """
+    Recorre solo la página visible de `matches`. Al terminar dibuja el botón
+    "Mostrar más", que amplía la página en EXPLORER_PAGE_SIZE elementos.
+    """
+    shown_key = f"{key}_shown"
+    shown = st.session_state.get(shown_key, EXPLORER_PAGE_SIZE)
+    
+    yield from matches[:shown]
+    
+    if len(matches) > shown:
+        st.caption(f"Mostrando {shown} de {len(matches)}")
+        st.button(
+            "⬇️ Mostrar más", key=f"{key}_more",
+            on_click=lambda: st.session_state.update({shown_key: shown + EXPLORER_PAGE_SIZE})
+        )
+
+
 def render_layers_explorer(store):
     """Explorador de capas geoespaciales"""
     if not store.layers:
         st.info("No se encontraron capas geoespaciales")
         return
     
-    for name, layer in store.layers.items():
-        with st.expander(f"📍 {name} ({layer.format.upper()})", expanded=False):
-            col1, col2 = st.columns([2, 1])
-            
-            with col1:
-                st.markdown(f"""
-                - **Geometría:** {layer.geometry_type or 'No determinado'}
-                - **CRS:** {layer.crs or 'No definido'}
-                - **Elementos:** {layer.feature_count:,}
-                - **Columnas:** {len(layer.columns)}
-                """)
-                
-                if layer.columns:
-                    st.caption(f"Atributos: {', '.join(layer.columns[:8])}{'...' if len(layer.columns) > 8 else ''}")
-            
-            with col2:
-                if layer.loaded:
-                    st.success("✅ En memoria")
-                else:
-                    if st.button(f"📥 Cargar", key=f"load_{name}"):
-                        with st.spinner(f"Cargando {name}..."):
-                            gdf = store.load_layer(name)
-                            if gdf is not None:
-                                st.success(f"Cargada: {len(gdf)} elementos")
-                                st.rerun()
-                            else:
-                                st.error("Error al cargar")
+    layers = filter_explorer_items(store.layers, "kb_layers", lambda layer: layer.format)
+    for name, layer in page_explorer_items(layers, "kb_layers"):
+        render_layer_row(store, name, layer)
+
+
+@st.fragment
+def render_layer_row(store, name, layer):
+    """
+    Fila de una capa. Es un fragmento: "Cargar" re-ejecuta solo esta fila, no
+    las demás ni la página (las métricas se actualizan en el siguiente rerun).
+    """
+    with st.expander(f"📍 {name} ({layer.format.upper()})", expanded=False):
+        col1, col2 = st.columns([2, 1])
+        
+        with col1:
+            st.markdown(f"""
+            - **Geometría:** {layer.geometry_type or 'No determinado'}
+            - **CRS:** {layer.crs or 'No definido'}
+            - **Elementos:** {format_count(layer.feature_count)}
+            - **Columnas:** {len(layer.columns)}
+            """)
             
-            # Vista previa si está cargada
-            if layer.loaded and layer.gdf is not None:
-                st.dataframe(layer.gdf.drop(columns='geometry').head(5), use_container_width=True)
+            if layer.columns:
+                st.caption(f"Atributos: {', '.join(layer.columns[:8])}{'...' if len(layer.columns) > 8 else ''}")
+        
+        with col2:
+            if layer.loaded:
+                st.success("✅ En memoria")
+            else:
+                # La carga corre en el callback, antes de re-ejecutar la fila:
+                # si tuvo éxito la fila ya se dibuja como "En memoria"
+                if st.button(f"📥 Cargar", key=f"load_{name}",
+                             on_click=store.load_layer, args=(name,)):
+                    st.error("Error al cargar")
+        
+        # Vista previa si está cargada
+        if layer.preview is not None:
+            st.dataframe(layer.preview, use_container_width=True)
 
 
 def render_documents_explorer(store):
@@ -183,7 +244,8 @@ def render_documents_explorer(store):
         st.info("No se encontraron documentos")
         return
     
-    for name, doc in store.documents.items():
+    documents = filter_explorer_items(store.documents, "kb_docs", lambda doc: doc.format)
+    for name, doc in page_explorer_items(documents, "kb_docs"):
         with st.expander(f"📄 {name}.{doc.format}", expanded=False):
             st.markdown(f"""
             - **Formato:** {doc.format.upper()}
@@ -207,6 +269,39 @@ def render_maps_explorer(store):
             st.info("💡 Los proyectos QGIS se pueden abrir directamente en QGIS Desktop")
 
 
+# Bloques HTML del estado en el sidebar: se arman una vez al importar el
+# módulo y en cada rerun solo se sustituyen los contadores
+KB_SIDEBAR_CONNECTED_HTML = Template("""
+<div style="
+    background: linear-gradient(135deg, #1a5f4a 0%, #2d8a6e 100%);
+    padding: 0.8rem;
+    border-radius: 8px;
+    color: white;
+    margin-bottom: 0.5rem;
+">
+    <div style="font-size: 0.75rem; opacity: 0.9;">✅ Conectado</div>
+    <div style="font-size: 0.85rem; font-weight: 600;">
+        ${capas} capas • ${docs} docs
+    </div>
+</div>
+""")
+
+KB_SIDEBAR_DISCONNECTED_HTML = """
+<div style="
+    background: #f8fafc;
+    border: 2px dashed #94a3b8;
+    padding: 1rem;
+    border-radius: 8px;
+    text-align: center;
+">
+    <div style="font-size: 1.5rem;">📁</div>
+    <div style="font-size: 0.8rem; color: #64748b;">
+        Sin conexión
+    </div>
+</div>
+"""
+
+
 def render_knowledge_base_sidebar():
     """
     Versión compacta para el sidebar.
@@ -220,40 +315,17 @@ def render_knowledge_base_sidebar():
         summary = store.get_summary()
         
         # Indicador de estado
-        st.markdown(f"""
-        <div style="
-            background: linear-gradient(135deg, #1a5f4a 0%, #2d8a6e 100%);
-            padding: 0.8rem;
-            border-radius: 8px;
-            color: white;
-            margin-bottom: 0.5rem;
-        ">
-            <div style="font-size: 0.75rem; opacity: 0.9;">✅ Conectado</div>
-            <div style="font-size: 0.85rem; font-weight: 600;">
-                {summary['total_capas']} capas • {summary['total_documentos']} docs
-            </div>
-        </div>
-        """, unsafe_allow_html=True)
+        st.markdown(KB_SIDEBAR_CONNECTED_HTML.substitute(
+            capas=summary['total_capas'],
+            docs=summary['total_documentos']
+        ), unsafe_allow_html=True)
         
         # Botón de re-escaneo
         if st.button("🔄 Actualizar", key="sidebar_refresh", use_container_width=True):
             store.connect(str(store.root_path))
             st.rerun()
     else:
-        st.markdown("""
-        <div style="
-            background: #f8fafc;
-            border: 2px dashed #94a3b8;
-            padding: 1rem;
-            border-radius: 8px;
-            text-align: center;
-        ">
-            <div style="font-size: 1.5rem;">📁</div>
-            <div style="font-size: 0.8rem; color: #64748b;">
-                Sin conexión
-            </div>
-        </div>
-        """, unsafe_allow_html=True)
+        st.markdown(KB_SIDEBAR_DISCONNECTED_HTML, unsafe_allow_html=True)
         
         st.caption("Ve a 'Base de Conocimiento' para conectar")
 
@@ -268,14 +340,7 @@ def get_kb_layers_for_selector() -> dict:
     if not store.is_connected:
         return {}
     
-    return {
-        name: {
-            'info': layer.to_dict(),
-            'loaded': layer.loaded,
-            'gdf': layer.gdf
-        }
-        for name, layer in store.layers.items()
-    }
+    return store.get_layers_for_selector()
 
 
 def load_kb_layer(layer_name: str):
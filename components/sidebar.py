@@ -6,11 +6,13 @@ Configuración y controles del sidebar.
 
 import streamlit as st
 from pathlib import Path
+from string import Template
 import sys
 
 sys.path.insert(0, str(Path(__file__).parent.parent))
 
 from core.data_store import get_store
+from components.chat import clear_chat
 
 
 def render_sidebar() -> dict:
@@ -85,7 +87,7 @@ def render_sidebar() -> dict:
     
     with col1:
         if st.button("🗑️ Limpiar chat", use_container_width=True):
-            st.session_state.messages = []
+            clear_chat()
             st.rerun()
     
     with col2:
@@ -100,6 +102,41 @@ def render_sidebar() -> dict:
     }
 
 
+# Bloques HTML del estado de la base de conocimiento: se arman una vez al
+# importar el módulo y en cada rerun solo se sustituyen los contadores
+KB_CONNECTED_HTML = Template("""
+<div style="
+    background: linear-gradient(135deg, #1a5f4a 0%, #2d8a6e 100%);
+    padding: 0.8rem;
+    border-radius: 8px;
+    color: white;
+">
+    <div style="font-size: 0.75rem; opacity: 0.9;">✅ Conectado</div>
+    <div style="font-size: 1rem; font-weight: 600; margin-top: 0.25rem;">
+        ${capas} capas • ${docs} docs
+    </div>
+    <div style="font-size: 0.7rem; opacity: 0.8; margin-top: 0.25rem;">
+        ${loaded} capas en memoria
+    </div>
+</div>
+""")
+
+KB_DISCONNECTED_HTML = """
+<div style="
+    background: #fef3c7;
+    border: 1px solid #f59e0b;
+    padding: 0.8rem;
+    border-radius: 8px;
+    text-align: center;
+">
+    <div style="font-size: 1.2rem;">📁</div>
+    <div style="font-size: 0.8rem; color: #92400e;">
+        No conectado
+    </div>
+</div>
+"""
+
+
 def render_kb_status():
     """Renderiza estado de la base de conocimiento en el sidebar"""
     
@@ -110,42 +147,18 @@ def render_kb_status():
     if store.is_connected:
         summary = store.get_summary()
         
-        st.markdown(f"""
-        <div style="
-            background: linear-gradient(135deg, #1a5f4a 0%, #2d8a6e 100%);
-            padding: 0.8rem;
-            border-radius: 8px;
-            color: white;
-        ">
-            <div style="font-size: 0.75rem; opacity: 0.9;">✅ Conectado</div>
-            <div style="font-size: 1rem; font-weight: 600; margin-top: 0.25rem;">
-                {summary['total_capas']} capas • {summary['total_documentos']} docs
-            </div>
-            <div style="font-size: 0.7rem; opacity: 0.8; margin-top: 0.25rem;">
-                {summary['capas_cargadas']} capas en memoria
-            </div>
-        </div>
-        """, unsafe_allow_html=True)
+        st.markdown(KB_CONNECTED_HTML.substitute(
+            capas=summary['total_capas'],
+            docs=summary['total_documentos'],
+            loaded=summary['capas_cargadas']
+        ), unsafe_allow_html=True)
         
         if st.button("🔄 Actualizar", key="kb_refresh", use_container_width=True):
             store.connect(str(store.root_path))
             st.rerun()
             
     else:
-        st.markdown("""
-        <div style="
-            background: #fef3c7;
-            border: 1px solid #f59e0b;
-            padding: 0.8rem;
-            border-radius: 8px;
-            text-align: center;
-        ">
-            <div style="font-size: 1.2rem;">📁</div>
-            <div style="font-size: 0.8rem; color: #92400e;">
-                No conectado
-            </div>
-        </div>
-        """, unsafe_allow_html=True)
+        st.markdown(KB_DISCONNECTED_HTML, unsafe_allow_html=True)
         
         st.caption("Ve a 'Base de Conocimiento' para conectar una carpeta")
 
@@ -155,7 +168,7 @@ def export_conversation():
     import json
     from datetime import datetime
     
-    messages = st.session_state.get("messages", [])
+    messages = list(st.session_state.get("messages", []))
     
     if not messages:
         st.warning("No hay mensajes para exportar")
@@ -167,11 +180,16 @@ def export_conversation():
         "messages": messages
     }
     
-    json_str = json.dumps(export_data, indent=2, ensure_ascii=False)
+    # orjson serializa directo a bytes UTF-8; si no está instalado, json estándar
+    try:
+        import orjson
+        json_bytes = orjson.dumps(export_data, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS)
+    except ImportError:
+        json_bytes = json.dumps(export_data, indent=2, ensure_ascii=False).encode('utf-8')
     
     st.download_button(
         "💾 Descargar JSON",
-        data=json_str,
+        data=json_bytes,
         file_name=f"geoia_chat_{datetime.now().strftime('%Y%m%d_%H%M')}.json",
         mime="application/json"
     )
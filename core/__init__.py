@@ -1,17 +1,36 @@
 """
 GeoIA Territorial v3.0 - Core Package
+
+Los submódulos se importan bajo demanda (PEP 562): usar el store no arrastra
+el motor de ejecución (matplotlib, folium) ni geopandas hasta que se necesitan.
 """
 
-from .data_store import GeoDataStore, get_store, init_store, LayerInfo, DocumentInfo
-from .execution_engine import CodeExecutionEngine, GeoProcessingTools, generate_geoprocessing_code
-
-__all__ = [
-    'GeoDataStore',
-    'get_store',
-    'init_store',
-    'LayerInfo',
-    'DocumentInfo',
-    'CodeExecutionEngine',
-    'GeoProcessingTools',
-    'generate_geoprocessing_code'
-]
+import importlib
+
+# Símbolo exportado -> submódulo que lo define
+_EXPORTS = {
+    'GeoDataStore': 'data_store',
+    'get_store': 'data_store',
+    'init_store': 'data_store',
+    'LayerInfo': 'data_store',
+    'DocumentInfo': 'data_store',
+    'CodeExecutionEngine': 'execution_engine',
+    'GeoProcessingTools': 'execution_engine',
+    'generate_geoprocessing_code': 'execution_engine',
+}
+
+__all__ = list(_EXPORTS)
+
+
+def __getattr__(name: str):
+    if name not in _EXPORTS:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+    module = importlib.import_module(f".{_EXPORTS[name]}", __name__)
+    value = getattr(module, name)
+    globals()[name] = value  # Accesos siguientes no pasan por __getattr__
+    return value
+
+
+def __dir__():
+    return sorted(list(globals()) + __all__)
@@ -5,18 +5,63 @@ Este módulo es el NÚCLEO de la interconexión entre todos los componentes.
 Cuando se carga la base de conocimiento, todos los módulos se sincronizan automáticamente.
 """
 
+from __future__ import annotations
+
 import streamlit as st
-import geopandas as gpd
-import pandas as pd
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
+from pyproj import CRS
 from pathlib import Path
-from typing import Dict, List, Optional, Any, Callable
+from typing import Dict, List, Optional, Any, Callable, TYPE_CHECKING
 from dataclasses import dataclass, field
 from datetime import datetime
-import json
-import hashlib
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from core.layer_io import read_layer
+from core.scan_cache import CACHE_FILE, file_fingerprint, file_version, load_cache, save_cache
+
+# geopandas se importa al leer la primera capa: conectar y escanear solo
+# necesitan pyogrio, y así arrancar la app no paga la importación completa
+if TYPE_CHECKING:
+    import geopandas as gpd
+    import pandas as pd
+
+
+@st.cache_resource(show_spinner=False, max_entries=64)
+def read_layer_file(path: str, version: tuple) -> gpd.GeoDataFrame:
+    """
+    Lee una capa del disco una sola vez por proceso.
+    La clave incluye la versión (file_version: tamaño y mtime del archivo y,
+    en shapefiles, de .shx/.dbf/.prj/.cpg): si cualquiera cambia, se vuelve a leer.
+    El GeoDataFrame se comparte entre sesiones; no modificarlo in situ.
+    """
+    gdf = read_layer(path)
+    # El índice espacial (STRtree) se construye aquí una sola vez y viaja con el
+    # objeto cacheado: overlays, clips y sjoin posteriores lo reutilizan
+    gdf.sindex
+    return gdf
+
+
+@st.cache_resource(show_spinner=False, max_entries=32)
+def reproject_layer(path: str, version: tuple, crs_wkt: str, _gdf: gpd.GeoDataFrame) -> gpd.GeoDataFrame:
+    """Versión reproyectada de una capa, cacheada por (archivo, file_version, CRS destino)"""
+    return _gdf.to_crs(crs_wkt)
+
 
+# Capas con más columnas no guardan vista previa en memoria
+PREVIEW_MAX_COLUMNS = 100
 
-@dataclass
+# CRS de los mapas web (Folium/Leaflet)
+WGS84 = CRS.from_epsg(4326)
+
+
+def format_count(count: Optional[int]) -> str:
+    """Número de elementos con separador de miles; '?' si no se conoce"""
+    return "?" if count is None else f"{count:,}"
+
+
+@dataclass(slots=True)
 class LayerInfo:
     """Información de una capa geoespacial"""
     name: str
@@ -24,11 +69,12 @@ class LayerInfo:
     format: str
     geometry_type: Optional[str] = None
     crs: Optional[str] = None
-    feature_count: int = 0
+    feature_count: Optional[int] = 0  # None: el driver no da el conteo sin recorrer la capa
     columns: List[str] = field(default_factory=list)
     bounds: Optional[tuple] = None
     loaded: bool = False
     gdf: Optional[gpd.GeoDataFrame] = None
+    preview: Optional[pd.DataFrame] = None  # Primeras filas, sin geometría
     
     def to_dict(self) -> dict:
         return {
@@ -42,9 +88,23 @@ class LayerInfo:
             "bounds": self.bounds,
             "loaded": self.loaded
         }
+    
+    @classmethod
+    def from_dict(cls, data: dict) -> "LayerInfo":
+        """Reconstruye los metadatos guardados por to_dict (sin GeoDataFrame)"""
+        return cls(
+            name=data["name"],
+            path=Path(data["path"]),
+            format=data["format"],
+            geometry_type=data.get("geometry_type"),
+            crs=data.get("crs"),
+            feature_count=data.get("feature_count", 0),
+            columns=list(data.get("columns", [])),
+            bounds=tuple(data["bounds"]) if data.get("bounds") is not None else None
+        )
 
 
-@dataclass
+@dataclass(slots=True)
 class DocumentInfo:
     """Información de un documento"""
     name: str
@@ -70,8 +130,15 @@ class GeoDataStore:
         self.layers: Dict[str, LayerInfo] = {}
         self.documents: Dict[str, DocumentInfo] = {}
         self.maps: Dict[str, Path] = {}
+        self.loaded_layers: set = set()  # Nombres de capas con GeoDataFrame en memoria
         self.is_connected: bool = False
         self.last_scan: Optional[datetime] = None
+        self.version: int = 0  # Se incrementa en cada mutación del estado
+        self._scan_cache: Dict[str, Any] = {}    # Entradas leídas de la caché de escaneo
+        self._scan_entries: Dict[str, Any] = {}  # Entradas del escaneo en curso
+        self._context_cache: tuple = (None, "")  # (cache_token, contexto para el chat)
+        self._selector_cache: tuple = (None, {})  # (cache_token, capas para selectores)
+        self._folder_fingerprint: Optional[int] = None  # Huella del último escaneo
         self._observers: List[Callable] = []
         
     def connect(self, path: str) -> Dict[str, Any]:
@@ -84,16 +151,33 @@ class GeoDataStore:
         if not root.exists():
             return {"success": False, "error": f"La carpeta no existe: {path}"}
         
+        # Re-escanear una carpeta sin cambios no toca el estado: ni limpia las
+        # capas cargadas ni invalida las cachés de los módulos ni notifica
+        entries, fingerprint = self._list_folder(root)
+        if self.is_connected and root == self.root_path and fingerprint == self._folder_fingerprint:
+            return {
+                "success": True,
+                "summary": self._scan_summary(),
+                "timestamp": self.last_scan.isoformat(),
+                "unchanged": True
+            }
+        
         self.root_path = root
         self.layers = {}
         self.documents = {}
         self.maps = {}
+        self.loaded_layers = set()
         
-        # Escanear estructura
-        scan_result = self._scan_folder(root)
+        # Escanear estructura: solo se analizan las capas cuya huella cambió
+        self._scan_cache = load_cache(root)
+        self._scan_entries = {}
+        scan_result = self._scan_folder(root, entries)
+        save_cache(root, self._scan_entries)
+        self._folder_fingerprint = fingerprint
         
         self.is_connected = True
         self.last_scan = datetime.now()
+        self.version += 1
         
         # Notificar a todos los observadores (módulos)
         self._notify_observers("connected", scan_result)
@@ -104,87 +188,159 @@ class GeoDataStore:
             "timestamp": self.last_scan.isoformat()
         }
     
-    def _scan_folder(self, root: Path) -> Dict[str, int]:
-        """Escanea recursivamente la carpeta"""
+    @staticmethod
+    def _scan_scopes(root: Path) -> Dict[str, Path]:
+        """Cada tipo se busca en su subcarpeta (capas/, documentos/, mapas/) o, si no existe, en la raíz"""
+        scopes = {}
+        for kind in ("capas", "documentos", "mapas"):
+            folder = root / kind
+            scopes[kind] = folder if folder.exists() else root
+        return scopes
+    
+    def _list_folder(self, root: Path) -> tuple:
+        """
+        Recorre una sola vez las carpetas a escanear. Devuelve los archivos
+        (os.DirEntry) y una huella de rutas, tamaños y mtimes para detectar
+        re-escaneos sin cambios. La caché de escaneo se reescribe en cada
+        escaneo, así que queda fuera.
+        """
+        scopes = self._scan_scopes(root)
+        # Carpetas a recorrer: la raíz cubre a todas las demás
+        walk_roots = [root] if root in scopes.values() else list(dict.fromkeys(scopes.values()))
         
-        # Buscar capas
-        capas_folder = root / "capas"
-        if capas_folder.exists():
-            self._scan_layers(capas_folder)
-        else:
-            # Buscar en raíz también
-            self._scan_layers(root)
+        entries = [
+            entry for walk_root in walk_roots for entry in self._walk(walk_root)
+            if entry.name != CACHE_FILE
+        ]
+        fingerprint = []
+        for entry in entries:
+            try:
+                stat = entry.stat()
+                fingerprint.append((entry.path, stat.st_size, stat.st_mtime_ns))
+            except OSError:
+                fingerprint.append((entry.path, None, None))
+        return entries, hash(tuple(fingerprint))
+    
+    def _scan_folder(self, root: Path, entries: List[os.DirEntry]) -> Dict[str, int]:
+        """Clasifica los archivos recorridos por extensión y subcarpeta"""
+        prefixes = {kind: os.path.join(str(folder), "") for kind, folder in self._scan_scopes(root).items()}
+        processed_shapefiles = set()
+        layer_files = []
         
-        # Buscar documentos
-        docs_folder = root / "documentos"
-        if docs_folder.exists():
-            self._scan_documents(docs_folder)
-        else:
-            self._scan_documents(root)
-            
-        # Buscar mapas QGIS
-        maps_folder = root / "mapas"
-        if maps_folder.exists():
-            self._scan_maps(maps_folder)
-        else:
-            self._scan_maps(root)
+        for entry in entries:
+            suffix = os.path.splitext(entry.name)[1].lower()
             
+            if suffix in self.LAYER_EXTENSIONS and entry.path.startswith(prefixes["capas"]):
+                if self._is_new_layer(entry, processed_shapefiles):
+                    layer_files.append(Path(entry.path))
+            elif suffix in self.DOC_EXTENSIONS and entry.path.startswith(prefixes["documentos"]):
+                self._add_document(entry)
+            elif suffix in self.MAP_EXTENSIONS and entry.path.startswith(prefixes["mapas"]):
+                self.maps[os.path.splitext(entry.name)[0]] = Path(entry.path)
+        
+        self._scan_layers(layer_files)
+        return self._scan_summary()
+    
+    def _scan_summary(self) -> Dict[str, int]:
         return {
             "capas": len(self.layers),
             "documentos": len(self.documents),
             "mapas": len(self.maps)
         }
     
-    def _scan_layers(self, folder: Path):
-        """Escanea capas geoespaciales"""
-        processed_shapefiles = set()
-        
-        for file in folder.rglob("*"):
-            if file.suffix.lower() in self.LAYER_EXTENSIONS:
-                # Evitar duplicados de shapefile
-                if file.suffix.lower() == '.shp':
-                    base_name = file.stem
-                    if base_name in processed_shapefiles:
+    @staticmethod
+    def _walk(folder: Path):
+        """Archivos bajo `folder` (recursivo) como os.DirEntry, sin crear un Path por entrada"""
+        pending = [str(folder)]
+        while pending:
+            try:
+                entries = os.scandir(pending.pop())
+            except OSError:
+                continue
+            with entries:
+                for entry in entries:
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            pending.append(entry.path)
+                        elif entry.is_file():
+                            yield entry
+                    except OSError:
                         continue
-                    processed_shapefiles.add(base_name)
-                
-                layer_info = self._analyze_layer(file)
+    
+    @staticmethod
+    def _is_new_layer(entry: os.DirEntry, processed_shapefiles: set) -> bool:
+        """Descarta los shapefiles ya vistos"""
+        # Evitar duplicados de shapefile
+        base_name, suffix = os.path.splitext(entry.name)
+        if suffix.lower() == '.shp':
+            if base_name in processed_shapefiles:
+                return False
+            processed_shapefiles.add(base_name)
+        return True
+    
+    def _scan_layers(self, files: List[Path]):
+        """
+        Analiza las capas en paralelo: read_info es E/S de GDAL y libera el GIL.
+        map conserva el orden de los archivos, así que los nombres repetidos se
+        resuelven igual que en un escaneo secuencial.
+        """
+        if not files:
+            return
+        
+        workers = min(32, (os.cpu_count() or 1) * 4, len(files))
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            for layer_info in pool.map(self._cached_layer_info, files):
                 if layer_info:
                     self.layers[layer_info.name] = layer_info
     
+    def _add_document(self, entry: os.DirEntry):
+        """Registra un documento; el tamaño sale del stat ya hecho por scandir"""
+        name, suffix = os.path.splitext(entry.name)
+        self.documents[name] = DocumentInfo(
+            name=name,
+            path=Path(entry.path),
+            format=suffix.lower().replace('.', ''),
+            size_kb=entry.stat().st_size / 1024
+        )
+    
+    def _cached_layer_info(self, file: Path) -> Optional[LayerInfo]:
+        """Metadatos de la caché de escaneo si el archivo no cambió; si no, se analiza"""
+        key = str(file)
+        fingerprint = file_fingerprint(file)
+        cached = self._scan_cache.get(key)
+        
+        if cached and cached.get("fingerprint") == fingerprint:
+            layer_info = LayerInfo.from_dict(cached["layer"])
+        else:
+            layer_info = self._analyze_layer(file)
+        
+        if layer_info:
+            self._scan_entries[key] = {"fingerprint": fingerprint, "layer": layer_info.to_dict()}
+        return layer_info
+    
     def _analyze_layer(self, file: Path) -> Optional[LayerInfo]:
-        """Analiza metadatos de una capa sin cargarla completamente"""
+        """Analiza metadatos de una capa sin cargarla (pyogrio lee solo la cabecera OGR)"""
         try:
-            # Lectura rápida solo de metadatos
-            gdf = gpd.read_file(file, rows=1)
+            import pyogrio
+            # Sin force_total_bounds: la extensión solo se toma si el formato la
+            # guarda (SHP, GPKG); en GeoJSON/KML obligaría a recorrer cada geometría
+            info = pyogrio.read_info(file)
             
-            # Obtener conteo real
-            if file.suffix.lower() == '.shp':
-                import fiona
-                with fiona.open(file) as src:
-                    count = len(src)
-            else:
-                # Para otros formatos, lectura completa
-                gdf_full = gpd.read_file(file)
-                count = len(gdf_full)
+            # -1: conteo desconocido (algunos drivers GeoJSON/KML); se completa al cargar
+            features = info.get('features', 0)
             
-            bounds = None
-            try:
-                gdf_bounds = gpd.read_file(file)
-                total_bounds = gdf_bounds.total_bounds
-                bounds = tuple(total_bounds)
-            except:
-                pass
+            geometry_type = info.get('geometry_type')
+            bounds = info.get('total_bounds')
             
             return LayerInfo(
                 name=file.stem,
                 path=file,
                 format=file.suffix.lower().replace('.', ''),
-                geometry_type=gdf.geometry.geom_type.iloc[0] if len(gdf) > 0 else None,
-                crs=str(gdf.crs) if gdf.crs else None,
-                feature_count=count,
-                columns=[c for c in gdf.columns if c != 'geometry'],
-                bounds=bounds
+                geometry_type=geometry_type if geometry_type not in (None, 'Unknown') else None,
+                crs=info.get('crs'),
+                feature_count=features if features >= 0 else None,
+                columns=list(info.get('fields', [])),
+                bounds=tuple(bounds) if bounds is not None else None
             )
         except Exception as e:
             # Si falla el análisis, crear info básica
@@ -194,52 +350,94 @@ class GeoDataStore:
                 format=file.suffix.lower().replace('.', '')
             )
     
-    def _scan_documents(self, folder: Path):
-        """Escanea documentos"""
-        for file in folder.rglob("*"):
-            if file.suffix.lower() in self.DOC_EXTENSIONS and file.is_file():
-                self.documents[file.stem] = DocumentInfo(
-                    name=file.stem,
-                    path=file,
-                    format=file.suffix.lower().replace('.', ''),
-                    size_kb=file.stat().st_size / 1024
-                )
-    
-    def _scan_maps(self, folder: Path):
-        """Escanea proyectos de mapas"""
-        for file in folder.rglob("*"):
-            if file.suffix.lower() in self.MAP_EXTENSIONS:
-                self.maps[file.stem] = file
-    
     def load_layer(self, layer_name: str) -> Optional[gpd.GeoDataFrame]:
         """Carga una capa específica en memoria"""
+        gdf, fresh = self._load_layer(layer_name)
+        
+        # Notificar que se cargó una capa
+        if fresh:
+            self._notify_observers("layer_loaded", {"name": layer_name, "gdf": gdf})
+        
+        return gdf
+    
+    def _load_layer(self, layer_name: str):
+        """Carga la capa sin notificar; devuelve (gdf, True si se acaba de cargar)"""
         if layer_name not in self.layers:
-            return None
+            return None, False
         
         layer = self.layers[layer_name]
         
         if layer.gdf is not None:
-            return layer.gdf
+            return layer.gdf, False
         
         try:
-            gdf = gpd.read_file(layer.path)
+            gdf = read_layer_file(str(layer.path), file_version(layer.path))
             layer.gdf = gdf
             layer.loaded = True
-            
-            # Notificar que se cargó una capa
-            self._notify_observers("layer_loaded", {"name": layer_name, "gdf": gdf})
-            
-            return gdf
+            layer.feature_count = len(gdf)
+            # La vista previa del explorador se arma una sola vez por carga
+            if len(gdf.columns) <= PREVIEW_MAX_COLUMNS:
+                layer.preview = gdf.head(5).drop(columns=gdf.geometry.name, errors='ignore')
+            self.loaded_layers.add(layer_name)
+            self.version += 1
+            return gdf, True
         except Exception as e:
-            return None
+            return None, False
+    
+    def prefetch_layers(self, layer_names: List[str]):
+        """
+        Lee del disco en paralelo las capas aún no cargadas. GDAL libera el GIL
+        durante la lectura; los resultados quedan en la caché de read_layer_file
+        y load_layer los recoge después sin volver a leer. Los errores se ignoran
+        aquí: load_layer los resuelve como siempre.
+        Los hilos heredan el contexto de la sesión que los lanza, como los del
+        propio Streamlit: sin él, la caché avisa de que falta el ScriptRunContext.
+        """
+        paths = [self.layers[name].path for name in layer_names
+                 if name in self.layers and self.layers[name].gdf is None]
+        if len(paths) < 2:
+            return
+        
+        def read(path: Path):
+            try:
+                read_layer_file(str(path), file_version(path))
+            except Exception:
+                pass
+        
+        ctx = get_script_run_ctx()
+        with ThreadPoolExecutor(
+            max_workers=min(8, len(paths)),
+            initializer=lambda: add_script_run_ctx(threading.current_thread(), ctx),
+        ) as pool:
+            list(pool.map(read, paths))
+    
+    def load_layer_as(self, layer_name: str, crs) -> Optional[gpd.GeoDataFrame]:
+        """Carga una capa en el CRS indicado; la reproyección se hace una vez por archivo y CRS"""
+        gdf = self.load_layer(layer_name)
+        if gdf is None or crs is None or gdf.crs is None or gdf.crs == crs:
+            return gdf
+        
+        _, path, version = self.layer_cache_key(layer_name)
+        return reproject_layer(path, version, crs.to_wkt(), gdf)
+    
+    def load_layer_wgs84(self, layer_name: str) -> Optional[gpd.GeoDataFrame]:
+        """Capa en WGS84 para mapas web, reproyectada una sola vez por archivo"""
+        return self.load_layer_as(layer_name, WGS84)
     
     def load_all_layers(self) -> Dict[str, gpd.GeoDataFrame]:
-        """Carga todas las capas en memoria"""
+        """Carga todas las capas en memoria con una sola notificación al final"""
+        self.prefetch_layers(list(self.layers))
         loaded = {}
+        fresh = {}
         for name in self.layers:
-            gdf = self.load_layer(name)
+            gdf, is_fresh = self._load_layer(name)
             if gdf is not None:
                 loaded[name] = gdf
+            if is_fresh:
+                fresh[name] = gdf
+        
+        if fresh:
+            self._notify_observers("layers_loaded_batch", fresh)
         return loaded
     
     def get_layer_names(self) -> List[str]:
@@ -256,29 +454,53 @@ class GeoDataStore:
         """Retorna información de todas las capas"""
         return [layer.to_dict() for layer in self.layers.values()]
     
+    def get_layers_for_selector(self) -> Dict[str, Dict]:
+        """
+        Capas para los selectores de otros módulos: {nombre: {info, loaded, gdf}}.
+        Se reconstruye solo cuando cambia el estado del store (cache_token).
+        """
+        token = self.cache_token()
+        if self._selector_cache[0] != token:
+            self._selector_cache = (token, {
+                name: {
+                    'info': layer.to_dict(),
+                    'loaded': layer.loaded,
+                    'gdf': layer.gdf
+                }
+                for name, layer in self.layers.items()
+            })
+        return self._selector_cache[1]
+    
     def get_context_for_chat(self) -> str:
         """
         Genera contexto estructurado para el Chat Inteligente.
         Incluye información sobre capas, documentos y mapas disponibles.
+        Se reconstruye solo cuando cambia el estado del store (cache_token).
         """
         if not self.is_connected:
             return ""
         
+        token = self.cache_token()
+        if self._context_cache[0] == token:
+            return self._context_cache[1]
+        
         context_parts = []
         
         # Información de capas
         if self.layers:
             context_parts.append("=== CAPAS GEOESPACIALES DISPONIBLES ===")
             for name, layer in self.layers.items():
-                layer_desc = f"""
-📍 **{name}** ({layer.format.upper()})
-   - Geometría: {layer.geometry_type or 'No determinado'}
-   - CRS: {layer.crs or 'No definido'}
-   - Elementos: {layer.feature_count}
-   - Columnas: {', '.join(layer.columns[:10])}{'...' if len(layer.columns) > 10 else ''}
-   - Ruta: {layer.path}
-"""
-                context_parts.append(layer_desc)
+                columns = ', '.join(layer.columns[:10]) + ('...' if len(layer.columns) > 10 else '')
+                context_parts += [
+                    "",
+                    f"📍 **{name}** ({layer.format.upper()})",
+                    f"   - Geometría: {layer.geometry_type or 'No determinado'}",
+                    f"   - CRS: {layer.crs or 'No definido'}",
+                    f"   - Elementos: {format_count(layer.feature_count)}",
+                    f"   - Columnas: {columns}",
+                    f"   - Ruta: {layer.path}",
+                    "",
+                ]
         
         # Información de documentos
         if self.documents:
@@ -292,7 +514,9 @@ class GeoDataStore:
             for name, path in self.maps.items():
                 context_parts.append(f"🗺️ {name} ({path.suffix})")
         
-        return "\n".join(context_parts)
+        context = "\n".join(context_parts)
+        self._context_cache = (token, context)
+        return context
     
     def get_summary(self) -> Dict[str, Any]:
         """Resumen general del store"""
@@ -302,32 +526,54 @@ class GeoDataStore:
             "total_capas": len(self.layers),
             "total_documentos": len(self.documents),
             "total_mapas": len(self.maps),
-            "capas_cargadas": sum(1 for l in self.layers.values() if l.loaded),
+            "capas_cargadas": len(self.loaded_layers),
             "last_scan": self.last_scan.isoformat() if self.last_scan else None
         }
     
+    def cache_token(self) -> tuple:
+        """
+        Identifica el estado actual del store para las cachés de Streamlit.
+        Cambia con cada conexión (last_scan) y con cada mutación (version).
+        """
+        return (str(self.root_path), self.last_scan, self.version)
+    
+    def layer_cache_key(self, layer_name: str) -> tuple:
+        """
+        Clave de caché de una capa: nombre, ruta y versión (file_version: en
+        shapefiles incluye .dbf/.prj/.cpg, así un CRS editado invalida las cachés)
+        """
+        path = self.layers[layer_name].path
+        return (layer_name, str(path), file_version(path))
+    
     # Sistema de observadores para notificaciones entre módulos
     def add_observer(self, callback: Callable):
         """Registra un observador para recibir notificaciones"""
         self._observers.append(callback)
     
     def _notify_observers(self, event: str, data: Any):
-        """Notifica a todos los observadores de un evento"""
-        for observer in self._observers:
+        """
+        Notifica a todos los observadores de un evento. Se recorre una copia
+        para que un observador pueda darse de baja durante la notificación.
+        """
+        for observer in list(self._observers):
             try:
                 observer(event, data)
-            except:
+            except Exception:
                 pass
 
 
 def get_store() -> GeoDataStore:
     """
     Obtiene la instancia global del store.
-    Se almacena en st.session_state para persistencia.
+    Se almacena en st.session_state para persistencia: cada sesión tiene su
+    propia conexión; lo compartido entre sesiones son las capas leídas
+    (read_layer_file). Una sola consulta a session_state por llamada; si se
+    desconectó (None) se crea un store vacío.
     """
-    if "geo_store" not in st.session_state:
-        st.session_state.geo_store = GeoDataStore()
-    return st.session_state.geo_store
+    store = st.session_state.get("geo_store")
+    if store is None:
+        store = st.session_state.geo_store = GeoDataStore()
+    return store
 
 
 def init_store():
@@ -4,18 +4,193 @@ GeoIA Territorial v3.0 - Motor de Ejecución de Código
 Permite al Chat Inteligente ejecutar código GeoPandas y generar mapas en vivo.
 """
 
+import ast
 import sys
 import io
 import traceback
+from collections.abc import Mapping
+from string import Template
+from types import CodeType, MappingProxyType, SimpleNamespace
 from typing import Dict, Any, Optional, Tuple
 import geopandas as gpd
 import pandas as pd
 import numpy as np
 import folium
 from folium.plugins import MarkerCluster, HeatMap
-import matplotlib.pyplot as plt
 import contextlib
+import functools
+import marshal
+import os
+import pickle
 import re
+import subprocess
+import weakref
+from pathlib import Path
+import shapely
+from concurrent.futures import ThreadPoolExecutor
+
+
+class ExecutionAborted(Exception):
+    """La ejecución aislada se interrumpió por tiempo o por memoria"""
+
+
+# Máximo de caracteres que el código puede imprimir (~10 MB)
+MAX_OUTPUT_CHARS = 10 * 1024 * 1024
+
+
+class CappedStringIO(io.StringIO):
+    """StringIO que falla al superar MAX_OUTPUT_CHARS: un print en bucle no agota la memoria"""
+    
+    def write(self, s: str) -> int:
+        if self.tell() + len(s) > MAX_OUTPUT_CHARS:
+            raise RuntimeError(f"Salida demasiado larga (más de {MAX_OUTPUT_CHARS:,} caracteres)")
+        return super().write(s)
+    
+    def reset(self):
+        """Vacía el buffer para reutilizarlo"""
+        self.seek(0)
+        self.truncate(0)
+
+
+# ══════════════════════════════════════════════════════════════════════════════
+# VALIDACIÓN DEL CÓDIGO
+# ══════════════════════════════════════════════════════════════════════════════
+# El código se analiza con ast en una sola pasada: a diferencia de buscar texto,
+# detecta `from os import path`, alias y accesos indirectos como
+# getattr(x, '__class__'), y no se confunde con comentarios o cadenas.
+
+# Módulos que no se pueden importar ni referenciar
+FORBIDDEN_MODULES = frozenset({
+    'os', 'sys', 'subprocess', 'shutil', 'pathlib', 'importlib', 'builtins',
+    'ctypes', 'socket', 'pickle', 'io', 'multiprocessing', 'threading',
+})
+
+# Funciones integradas prohibidas (como llamada o como referencia)
+FORBIDDEN_BUILTINS = frozenset({
+    'eval', 'exec', 'open', 'compile', 'input', '__import__',
+    'globals', 'locals', 'vars', 'breakpoint',
+})
+
+# Métodos destructivos sobre archivos
+FORBIDDEN_METHODS = frozenset({'remove', 'delete', 'rmdir', 'unlink', 'rmtree'})
+
+
+def find_forbidden(tree: ast.AST) -> Optional[str]:
+    """Describe la primera operación prohibida del árbol, o None si es seguro"""
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Import):
+            for alias in node.names:
+                if alias.name.split('.')[0] in FORBIDDEN_MODULES:
+                    return f"import {alias.name}"
+        
+        elif isinstance(node, ast.ImportFrom):
+            if (node.module or '').split('.')[0] in FORBIDDEN_MODULES:
+                return f"from {node.module} import ..."
+        
+        elif isinstance(node, ast.Name):
+            if node.id in FORBIDDEN_MODULES or node.id in FORBIDDEN_BUILTINS:
+                return node.id
+            if node.id.startswith('__'):
+                return node.id
+        
+        elif isinstance(node, ast.Attribute):
+            # Atributos dunder (__class__, __globals__...) abren salidas del sandbox
+            if node.attr.startswith('__'):
+                return f".{node.attr}"
+            # Módulos prohibidos alcanzados desde uno permitido (pd.io.common.os)
+            if node.attr in FORBIDDEN_MODULES or node.attr in FORBIDDEN_BUILTINS:
+                return f".{node.attr}"
+        
+        elif isinstance(node, ast.Call):
+            func = node.func
+            if isinstance(func, ast.Attribute) and func.attr in FORBIDDEN_METHODS:
+                return f".{func.attr}()"
+            
+            # getattr/hasattr solo con nombres literales que no sean dunder
+            # ni de módulos o funciones prohibidas
+            if isinstance(func, ast.Name) and func.id in ('getattr', 'hasattr') and len(node.args) > 1:
+                name = node.args[1]
+                if not (isinstance(name, ast.Constant) and isinstance(name.value, str)):
+                    return f"{func.id}() con nombre dinámico"
+                if (name.value.startswith('__') or name.value in FORBIDDEN_MODULES
+                        or name.value in FORBIDDEN_BUILTINS):
+                    return f"{func.id}(..., {name.value!r})"
+    
+    return None
+
+
+@functools.lru_cache(maxsize=128)
+def compile_user_code(code: str) -> Tuple[Optional[CodeType], Optional[str]]:
+    """
+    Analiza, valida y compila el código del usuario. Se cachea por texto del
+    código: las plantillas que el chat repite no se vuelven a compilar.
+    
+    Returns:
+        (código compilado, None) si es seguro; (None, mensaje de error) si no
+    """
+    try:
+        tree = ast.parse(code, filename="<codigo>")
+    except SyntaxError as e:
+        return None, f"SyntaxError: {e.msg} (línea {e.lineno})"
+    
+    forbidden = find_forbidden(tree)
+    if forbidden:
+        return None, f"Operación no permitida detectada: {forbidden}"
+    
+    return compile(tree, "<codigo>", "exec"), None
+
+
+def rejected_result(error: str) -> Dict[str, Any]:
+    """Resultado de un código que no pasó la validación"""
+    return {
+        "success": False,
+        "error": error,
+        "output": "",
+        "result": None,
+        "maps": [],
+        "figures": []
+    }
+
+
+class VariableSummary(Mapping):
+    """
+    Resumen {variable: nombre del tipo} de lo que definió el código, calculado
+    solo si alguien lo consulta. Se serializa como dict simple (sin los valores).
+    """
+    
+    def __init__(self, user_vars: Dict[str, Any]):
+        self._user_vars = user_vars
+    
+    @functools.cached_property
+    def _types(self) -> Dict[str, str]:
+        return {k: type(v).__name__ for k, v in self._user_vars.items() if not k.startswith('_')}
+    
+    def __getitem__(self, key: str) -> str:
+        return self._types[key]
+    
+    def __iter__(self):
+        return iter(self._types)
+    
+    def __len__(self) -> int:
+        return len(self._types)
+    
+    def __repr__(self) -> str:
+        return repr(self._types)
+    
+    def __reduce__(self):
+        return dict, (self._types,)
+
+
+# Caracteres no válidos en un nombre de variable
+_SANITIZE_RE = re.compile(r'[^a-zA-Z0-9_]')
+
+
+def layer_var_name(name: str) -> str:
+    """Nombre de variable de una capa: caracteres no ASCII-alfanuméricos pasan a '_'"""
+    # Caso habitual: el nombre ya es un identificador ASCII y la regex no cambiaría nada
+    if name.isascii() and name.isidentifier():
+        return name
+    return _SANITIZE_RE.sub('_', name)
 
 
 class CodeExecutionEngine:
@@ -37,41 +212,70 @@ class CodeExecutionEngine:
         'HeatMap': HeatMap
     }
     
-    # Operaciones peligrosas prohibidas
-    FORBIDDEN_PATTERNS = [
-        r'import\s+os',
-        r'import\s+subprocess',
-        r'import\s+sys',
-        r'__import__',
-        r'eval\s*\(',
-        r'exec\s*\(',
-        r'open\s*\(',
-        r'file\s*\(',
-        r'input\s*\(',
-        r'os\.',
-        r'subprocess\.',
-        r'shutil\.',
-        r'pathlib\.Path.*unlink',
-        r'\.remove\s*\(',
-        r'\.delete\s*\(',
-        r'\.rmdir\s*\(',
-    ]
-    
-    def __init__(self, layers: Dict[str, gpd.GeoDataFrame] = None):
+    # Builtins disponibles para el código generado (de solo lectura: se
+    # comparten entre ejecuciones y el código no debe poder alterarlos)
+    SAFE_BUILTINS = MappingProxyType({
+        'print': print,
+        'len': len,
+        'range': range,
+        'list': list,
+        'dict': dict,
+        'str': str,
+        'int': int,
+        'float': float,
+        'bool': bool,
+        'tuple': tuple,
+        'set': set,
+        'sum': sum,
+        'min': min,
+        'max': max,
+        'abs': abs,
+        'round': round,
+        'sorted': sorted,
+        'enumerate': enumerate,
+        'zip': zip,
+        'map': map,
+        'filter': filter,
+        'isinstance': isinstance,
+        'type': type,
+        'hasattr': hasattr,
+        'getattr': getattr,
+    })
+    
+    # Globales fijos de cada ejecución, construidos una sola vez
+    _BASE_GLOBALS = MappingProxyType({
+        '__builtins__': SAFE_BUILTINS,
+        **ALLOWED_MODULES,
+    })
+    
+    # Atributos públicos de folium, para el módulo sustituto de cada ejecución
+    _FOLIUM_ATTRS = MappingProxyType({
+        name: getattr(folium, name) for name in dir(folium) if not name.startswith('_')
+    })
+    
+    def __init__(self, layers: Mapping[str, gpd.GeoDataFrame] = None):
         """
         Inicializa el motor con las capas disponibles.
         
         Args:
-            layers: Diccionario de capas cargadas {nombre: GeoDataFrame}
+            layers: Capas {nombre: GeoDataFrame}: un dict ya cargado o un
+                LayerFiles que las lee del disco al pedirlas
         """
-        self.layers = layers or {}
+        self.set_layers(layers or {})
         self.results = {}
+        self._output_buffer = CappedStringIO()
         self.generated_maps = []
         self.generated_figures = []
         
-    def set_layers(self, layers: Dict[str, gpd.GeoDataFrame]):
-        """Actualiza las capas disponibles"""
+    def set_layers(self, layers: Mapping[str, gpd.GeoDataFrame]):
+        """Actualiza las capas disponibles y sus nombres como variables"""
         self.layers = layers
+        # Cada capa también queda como variable directa, con el nombre
+        # sanitizado: {variable: nombre de la capa}. Se recorren solo los
+        # nombres, así unas capas que se leen bajo demanda (LayerFiles) no se cargan
+        self._layer_var_names = {layer_var_name(name): name for name in layers}
+        # Nombres que el entorno define antes de ejecutar
+        self._preset_names = frozenset(self._BASE_GLOBALS) | self._layer_var_names.keys() | {'layers', 'capas'}
         
     def validate_code(self, code: str) -> Tuple[bool, str]:
         """
@@ -80,11 +284,8 @@ class CodeExecutionEngine:
         Returns:
             (is_valid, error_message)
         """
-        for pattern in self.FORBIDDEN_PATTERNS:
-            if re.search(pattern, code, re.IGNORECASE):
-                return False, f"Operación no permitida detectada: {pattern}"
-        
-        return True, ""
+        _, error = compile_user_code(code)
+        return error is None, error or ""
     
     def execute(self, code: str) -> Dict[str, Any]:
         """
@@ -96,77 +297,44 @@ class CodeExecutionEngine:
         Returns:
             Dict con resultado, salida, errores, mapas generados, etc.
         """
-        # Validar código
-        is_valid, error = self.validate_code(code)
-        if not is_valid:
-            return {
-                "success": False,
-                "error": error,
-                "output": "",
-                "result": None,
-                "maps": [],
-                "figures": []
-            }
+        # Validar y compilar el código (se analiza una sola vez)
+        code_obj, error = compile_user_code(code)
+        if error:
+            return rejected_result(error)
         
-        # Preparar entorno de ejecución
-        exec_globals = {
-            '__builtins__': {
-                'print': print,
-                'len': len,
-                'range': range,
-                'list': list,
-                'dict': dict,
-                'str': str,
-                'int': int,
-                'float': float,
-                'bool': bool,
-                'tuple': tuple,
-                'set': set,
-                'sum': sum,
-                'min': min,
-                'max': max,
-                'abs': abs,
-                'round': round,
-                'sorted': sorted,
-                'enumerate': enumerate,
-                'zip': zip,
-                'map': map,
-                'filter': filter,
-                'isinstance': isinstance,
-                'type': type,
-                'hasattr': hasattr,
-                'getattr': getattr,
-            },
-            **self.ALLOWED_MODULES,
-            'layers': self.layers,  # Acceso a las capas
-            'capas': self.layers,   # Alias en español
-        }
+        return self.execute_compiled(code_obj)
+    
+    def execute_compiled(self, code_obj: CodeType) -> Dict[str, Any]:
+        """Ejecuta código ya validado y compilado por compile_user_code"""
+        # Preparar entorno de ejecución: la parte fija se comparte entre
+        # ejecuciones; solo se añaden las capas
+        exec_globals = dict(self._BASE_GLOBALS)
+        exec_globals['layers'] = self.layers  # Acceso a las capas
+        exec_globals['capas'] = self.layers   # Alias en español
         
-        # Agregar cada capa como variable directa
-        for name, gdf in self.layers.items():
-            # Sanitizar nombre para usar como variable
-            safe_name = re.sub(r'[^a-zA-Z0-9_]', '_', name)
-            exec_globals[safe_name] = gdf
+        # Agregar como variable directa cada capa que el código nombra
+        referenced = code_names(code_obj)
+        for var_name, layer_name in self._layer_var_names.items():
+            if var_name in referenced:
+                exec_globals[var_name] = self.layers[layer_name]
         
-        # Capturar salida
-        output_buffer = io.StringIO()
+        # Capturar salida (el buffer se reutiliza entre ejecuciones)
+        output_buffer = self._output_buffer
+        output_buffer.reset()
         self.generated_maps = []
         self.generated_figures = []
         
-        # Interceptar creación de mapas
-        original_folium_map = folium.Map
-        
-        def capture_map(*args, **kwargs):
-            m = original_folium_map(*args, **kwargs)
-            self.generated_maps.append(m)
-            return m
-        
-        exec_globals['folium'].Map = capture_map
+        # Interceptar creación de mapas: el código ve un "folium" propio cuyo
+        # Map registra cada instancia; el módulo real no se modifica, así que
+        # ejecuciones concurrentes (otras sesiones) no se pisan
+        exec_globals['folium'] = SimpleNamespace(
+            **{**self._FOLIUM_ATTRS, 'Map': capturing_map_class(self.generated_maps)}
+        )
         
         try:
             with contextlib.redirect_stdout(output_buffer):
                 # Ejecutar código
-                exec(code, exec_globals)
+                exec(code_obj, exec_globals)
             
             # Buscar resultados relevantes
             result = None
@@ -175,8 +343,12 @@ class CodeExecutionEngine:
                     result = exec_globals[var_name]
                     break
             
-            # Si hay un mapa en las variables, capturarlo
-            for var_name, var_value in exec_globals.items():
+            # Variables que definió el código (los módulos y las capas no cuentan)
+            user_vars = {k: v for k, v in exec_globals.items() if k not in self._preset_names}
+            
+            # Los mapas de folium.Map ya están capturados; aquí solo se suman
+            # los creados por otras vías (p. ej. GeoDataFrame.explore())
+            for var_value in user_vars.values():
                 if isinstance(var_value, folium.Map) and var_value not in self.generated_maps:
                     self.generated_maps.append(var_value)
             
@@ -187,8 +359,7 @@ class CodeExecutionEngine:
                 "result": result,
                 "maps": self.generated_maps,
                 "figures": self.generated_figures,
-                "variables": {k: type(v).__name__ for k, v in exec_globals.items() 
-                            if not k.startswith('_') and k not in self.ALLOWED_MODULES}
+                "variables": VariableSummary(user_vars)
             }
             
         except Exception as e:
@@ -201,9 +372,204 @@ class CodeExecutionEngine:
                 "maps": [],
                 "figures": []
             }
-        finally:
-            # Restaurar folium.Map original
-            exec_globals['folium'].Map = original_folium_map
+    
+    def execute_isolated(self, code: str, timeout: float = 30, mem_mb: int = 2048) -> Dict[str, Any]:
+        """
+        Ejecuta el código en un intérprete aparte con límite de tiempo y de memoria,
+        para que un bucle infinito o un buffer descomunal no bloquee el servidor.
+        Las capas viajan tal como se pasaron al motor: con LayerFiles solo van
+        las rutas y el hijo lee del disco las capas que el código usa.
+        Se lanza `python -m core.execution_engine` en lugar de multiprocessing:
+        Streamlit registra el script de la app como __main__ y "spawn" lo
+        volvería a ejecutar entero en el hijo.
+        
+        Returns:
+            El mismo dict que execute(), ya serializable (ver serializable_result)
+        
+        Raises:
+            ExecutionAborted: si se agota el tiempo o el proceso muere (memoria)
+        """
+        # Se valida y compila aquí (con caché): el código rechazado no llega a
+        # lanzar el proceso y el hijo recibe el bytecode listo para ejecutar
+        code_obj, error = compile_user_code(code)
+        if error:
+            return serializable_result(rejected_result(error))
+        
+        try:
+            completed = subprocess.run(
+                [sys.executable, "-m", "core.execution_engine", str(mem_mb)],
+                input=pickle.dumps((self.layers, marshal.dumps(code_obj))),
+                capture_output=True,
+                timeout=timeout,
+                cwd=Path(__file__).resolve().parent.parent
+            )
+        except subprocess.TimeoutExpired:
+            raise ExecutionAborted(f"Tiempo de ejecución agotado ({timeout:g} s)")
+        
+        if completed.returncode != 0 or not completed.stdout:
+            raise ExecutionAborted(
+                f"El proceso de ejecución terminó inesperadamente (límite de memoria: {mem_mb} MB)"
+            )
+        return pickle.loads(completed.stdout)
+
+
+def serializable_result(result: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Convierte el resultado de execute() en datos serializables: los mapas Folium
+    pasan a HTML y cualquier resultado que no se pueda pickle se reemplaza por su repr.
+    """
+    result["maps"] = [m._repr_html_() for m in result["maps"]]
+    result["result_map_html"] = None
+    if isinstance(result["result"], folium.Map):
+        result["result_map_html"] = result["result"]._repr_html_()
+        result["result"] = None
+    
+    try:
+        pickle.dumps(result["result"])
+    except Exception:
+        result["result"] = repr(result["result"])
+    
+    return result
+
+
+def isolated_main(mem_mb: int):
+    """
+    Proceso hijo de CodeExecutionEngine.execute_isolated: lee (capas, código)
+    de stdin y escribe el resultado serializado en stdout.
+    """
+    try:
+        import resource
+        limit = mem_mb * 1024 * 1024
+        resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+    except (ImportError, ValueError, OSError):
+        pass  # Windows o límite no permitido: se ejecuta solo con el límite de tiempo
+    
+    # El descriptor 1 queda reservado para el resultado: cualquier otra salida
+    # (GDAL, librerías en C) se desvía a stderr
+    result_fd = os.dup(1)
+    os.dup2(2, 1)
+    
+    layers, code_bytes = pickle.loads(sys.stdin.buffer.read())
+    try:
+        code_obj = marshal.loads(code_bytes)
+        result = serializable_result(CodeExecutionEngine(layers).execute_compiled(code_obj))
+    except MemoryError:
+        result = {
+            "success": False,
+            "error": f"Memoria insuficiente: el código superó el límite de {mem_mb} MB",
+            "output": "",
+            "result": None,
+            "result_map_html": None,
+            "maps": [],
+            "figures": []
+        }
+    
+    with os.fdopen(result_fd, "wb") as out:
+        out.write(pickle.dumps(result))
+
+
+@functools.lru_cache(maxsize=64)
+def utm_crs_for_bounds(crs, bounds: tuple):
+    """UTM estimada para una extensión; pyproj consulta su base de datos una sola vez"""
+    return gpd.GeoSeries([shapely.box(*bounds)], crs=crs).estimate_utm_crs()
+
+
+def code_names(code_obj: CodeType) -> frozenset:
+    """
+    Nombres que usa el código compilado, incluidas funciones, lambdas y
+    comprensiones anidadas (co_names también trae atributos: es un superconjunto)
+    """
+    names = set(code_obj.co_names)
+    for const in code_obj.co_consts:
+        if isinstance(const, CodeType):
+            names |= code_names(const)
+    return frozenset(names)
+
+
+def capturing_map_class(maps: list) -> type:
+    """Subclase de folium.Map que añade a `maps` cada mapa que se crea"""
+    # Mismo nombre que la clase original: el código (y el resumen de
+    # variables) ve un folium.Map normal
+    class Map(folium.Map):
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            maps.append(self)
+    
+    return Map
+
+
+# Por debajo de este número de filas n_partitions se ignora: repartir cuesta más
+PARTITION_MIN_ROWS = 10_000
+
+
+def run_partitioned(gdf: gpd.GeoDataFrame, n_partitions: Optional[int], func,
+                    labels: Optional[np.ndarray] = None) -> Optional[list]:
+    """
+    Aplica `func` a particiones de filas de `gdf` en un pool de hilos y
+    devuelve los resultados en orden (None si no conviene particionar).
+    Shapely 2 libera el GIL dentro de GEOS, así que las particiones corren en
+    paralelo sin copiar las capas a otros procesos. `labels` asigna cada fila
+    a una partición (p. ej. por grupo); por defecto se reparten en bloques.
+    """
+    if not n_partitions or n_partitions < 2 or len(gdf) < PARTITION_MIN_ROWS:
+        return None
+    
+    if labels is None:
+        parts = np.array_split(np.arange(len(gdf)), n_partitions)
+    else:
+        parts = [np.flatnonzero(labels % n_partitions == i) for i in range(n_partitions)]
+    
+    with ThreadPoolExecutor(max_workers=n_partitions) as pool:
+        return list(pool.map(lambda positions: func(gdf.iloc[positions]), parts))
+
+
+# Con Copy-on-Write (siempre activo desde pandas 3) una copia superficial es
+# segura aunque el resultado se edite después; antes, compartiría los datos
+# con la capa original (que puede ser la del store, compartida entre sesiones)
+SHALLOW_COPY_SAFE = int(pd.__version__.split('.')[0]) >= 3
+
+
+def result_copy(gdf: gpd.GeoDataFrame) -> gpd.GeoDataFrame:
+    """Copia de la capa para un resultado; sin duplicar atributos si es seguro"""
+    return gdf.copy(deep=not SHALLOW_COPY_SAFE)
+
+
+def is_polygonal(gdf: gpd.GeoDataFrame) -> bool:
+    """True si todas las geometrías son Polygon o MultiPolygon (ids de tipo de Shapely 3 y 6)"""
+    return bool(np.isin(shapely.get_type_id(gdf.geometry.to_numpy()), [3, 6]).all())
+
+
+def is_coverage(gdf: gpd.GeoDataFrame) -> bool:
+    """
+    True si la capa es una cobertura poligonal válida (polígonos sin
+    solapamientos cuyos bordes compartidos coinciden vértice a vértice).
+    Cualquier subconjunto de una cobertura también lo es, así que vale por grupo.
+    """
+    return is_polygonal(gdf) and bool(shapely.coverage_is_valid(gdf.geometry.to_numpy()))
+
+
+def with_geometry(gdf: gpd.GeoDataFrame, geometries) -> gpd.GeoDataFrame:
+    """Copia de la capa con otra geometría (ver result_copy)"""
+    result = result_copy(gdf)
+    result[gdf.geometry.name] = geometries
+    return result
+
+
+# Ancho aproximado del mapa en píxeles: la tolerancia de simplificación por
+# defecto es la extensión / este valor, para no enviar vértices sub-píxel
+MAP_SIMPLIFY_PIXELS = 2000
+
+
+# Geometría reproyectada por capa de origen: {(id(capa), CRS): GeoSeries}. La
+# entrada se borra cuando la capa se libera, así un id reutilizado nunca da un falso acierto
+_projected_geometries: Dict[tuple, gpd.GeoSeries] = {}
+
+
+def _forget_projected_geometries(gdf_id: int):
+    # Se itera sobre una copia de las claves (list(dict) es atómico bajo el GIL):
+    # el finalizador corre en cualquier hilo, mientras otros insertan entradas
+    for key in [key for key in list(_projected_geometries) if key[0] == gdf_id]:
+        _projected_geometries.pop(key, None)
 
 
 class GeoProcessingTools:
@@ -211,17 +577,89 @@ class GeoProcessingTools:
     Herramientas de geoprocesamiento predefinidas que el chat puede invocar.
     """
     
+    @staticmethod
+    def utm_crs(gdf: gpd.GeoDataFrame):
+        """CRS UTM de la capa, cacheado por (CRS, extensión)"""
+        return utm_crs_for_bounds(gdf.crs, tuple(gdf.total_bounds))
+    
+    @staticmethod
+    def metric_geometry(gdf: gpd.GeoDataFrame) -> gpd.GeoSeries:
+        """
+        Geometría reproyectada a su UTM, calculada una vez por capa: áreas y
+        análisis repetidos sobre la misma capa reutilizan la proyección.
+        Como las capas del store, la capa no debe modificarse in situ.
+        """
+        return GeoProcessingTools.projected_geometry(gdf, GeoProcessingTools.utm_crs(gdf))
+    
+    @staticmethod
+    def projected_geometry(gdf: gpd.GeoDataFrame, crs) -> gpd.GeoSeries:
+        """Geometría de la capa en `crs`, reproyectada una sola vez por capa y CRS"""
+        key = (id(gdf), crs)
+        projected = _projected_geometries.get(key)
+        if projected is None:
+            projected = gdf.geometry.to_crs(crs)
+            if not any(k[0] == key[0] for k in list(_projected_geometries)):
+                weakref.finalize(gdf, _forget_projected_geometries, key[0])
+            _projected_geometries[key] = projected
+        return projected
+    
     @staticmethod
     def buffer(gdf: gpd.GeoDataFrame, distance: float, cap_style: int = 1) -> gpd.GeoDataFrame:
         """Crea buffer alrededor de geometrías"""
-        result = gdf.copy()
-        result['geometry'] = result.geometry.buffer(distance, cap_style=cap_style)
-        return result
+        return with_geometry(gdf, shapely.buffer(gdf.geometry.to_numpy(), distance, quad_segs=16, cap_style=cap_style))
     
     @staticmethod
-    def intersection(gdf1: gpd.GeoDataFrame, gdf2: gpd.GeoDataFrame) -> gpd.GeoDataFrame:
-        """Intersección de dos capas"""
-        return gpd.overlay(gdf1, gdf2, how='intersection')
+    def intersecting_positions(gdf1: gpd.GeoDataFrame, gdf2: gpd.GeoDataFrame):
+        """
+        Posiciones de las filas de cada capa que intersectan alguna de la otra,
+        según el índice espacial. overlay solo necesita esas filas: las demás
+        no aportan nada a la intersección y no cambian en la diferencia.
+        """
+        idx1, idx2 = gdf2.sindex.query(gdf1.geometry, predicate='intersects')
+        return np.unique(idx1), np.unique(idx2)
+    
+    @staticmethod
+    def intersection(gdf1: gpd.GeoDataFrame, gdf2: gpd.GeoDataFrame,
+                     n_partitions: Optional[int] = None) -> gpd.GeoDataFrame:
+        """Intersección de dos capas (n_partitions: bloques de gdf1 en paralelo)"""
+        parts = run_partitioned(gdf1, n_partitions,
+                                lambda part: GeoProcessingTools.intersection(part, gdf2))
+        if parts is not None:
+            return pd.concat(parts, ignore_index=True)
+        
+        if is_polygonal(gdf1) and is_polygonal(gdf2):
+            return GeoProcessingTools.polygon_intersection(gdf1, gdf2)
+        
+        idx1, idx2 = GeoProcessingTools.intersecting_positions(gdf1, gdf2)
+        return gpd.overlay(gdf1.iloc[idx1], gdf2.iloc[idx2], how='intersection')
+    
+    @staticmethod
+    def polygon_intersection(gdf1: gpd.GeoDataFrame, gdf2: gpd.GeoDataFrame) -> gpd.GeoDataFrame:
+        """
+        Intersección de dos capas de polígonos.
+        Empareja candidatos con una sola consulta al STRtree y recorta los pares
+        con la ufunc vectorizada de Shapely; mismo resultado que gpd.overlay.
+        """
+        # Pares (i de gdf1, j de gdf2) cuyas geometrías se intersectan
+        idx1, idx2 = gdf2.sindex.query(gdf1.geometry, predicate='intersects')
+        geoms = shapely.intersection(gdf1.geometry.to_numpy()[idx1], gdf2.geometry.to_numpy()[idx2])
+        
+        # Como overlay: de las colecciones mixtas solo se conserva la parte poligonal,
+        # y se descartan los pares que solo se tocan en bordes o vértices
+        mixed = shapely.get_type_id(geoms) == 7  # GeometryCollection
+        if mixed.any():
+            geoms[mixed] = shapely.buffer(geoms[mixed], 0)
+        keep = (shapely.get_dimensions(geoms) == 2) & ~shapely.is_empty(geoms)
+        
+        attrs1 = pd.DataFrame(gdf1.drop(columns=gdf1.geometry.name)).iloc[idx1[keep]].reset_index(drop=True)
+        attrs2 = pd.DataFrame(gdf2.drop(columns=gdf2.geometry.name)).iloc[idx2[keep]].reset_index(drop=True)
+        
+        # Sufijos _1/_2 para columnas repetidas, igual que overlay
+        shared = attrs1.columns.intersection(attrs2.columns)
+        attrs1 = attrs1.rename(columns={c: f"{c}_1" for c in shared})
+        attrs2 = attrs2.rename(columns={c: f"{c}_2" for c in shared})
+        
+        return gpd.GeoDataFrame(pd.concat([attrs1, attrs2], axis=1), geometry=geoms[keep], crs=gdf1.crs)
     
     @staticmethod
     def union(gdf1: gpd.GeoDataFrame, gdf2: gpd.GeoDataFrame) -> gpd.GeoDataFrame:
@@ -231,45 +669,81 @@ class GeoProcessingTools:
     @staticmethod
     def difference(gdf1: gpd.GeoDataFrame, gdf2: gpd.GeoDataFrame) -> gpd.GeoDataFrame:
         """Diferencia entre dos capas"""
-        return gpd.overlay(gdf1, gdf2, how='difference')
+        idx1, idx2 = GeoProcessingTools.intersecting_positions(gdf1, gdf2)
+        if len(idx1) == len(gdf1):
+            return gpd.overlay(gdf1, gdf2, how='difference')
+        if len(idx1) == 0:
+            return gdf1.reset_index(drop=True)
+        
+        # Solo se recortan las filas que tocan la otra capa; el resto pasa
+        # igual. La posición original mantiene el orden que daría overlay
+        positions = np.arange(len(gdf1))
+        touched = np.zeros(len(gdf1), dtype=bool)
+        touched[idx1] = True
+        
+        clipped = gpd.overlay(
+            gdf1.iloc[idx1].assign(_posicion=positions[idx1]), gdf2.iloc[idx2], how='difference'
+        )
+        untouched = gdf1.iloc[~touched].assign(_posicion=positions[~touched])
+        
+        result = pd.concat([clipped, untouched]).sort_values('_posicion')
+        return result.drop(columns='_posicion').reset_index(drop=True)
     
     @staticmethod
-    def dissolve(gdf: gpd.GeoDataFrame, by: str = None, aggfunc: str = 'sum') -> gpd.GeoDataFrame:
-        """Disuelve geometrías"""
+    def dissolve(gdf: gpd.GeoDataFrame, by: str = None, aggfunc: str = 'sum',
+                 n_partitions: Optional[int] = None, method: str = 'unary') -> gpd.GeoDataFrame:
+        """
+        Disuelve geometrías. Con `by` y n_partitions, cada grupo completo va a
+        una sola partición, así que cualquier aggfunc da el mismo resultado.
+        
+        method: 'unary' (unión general), 'coverage' (polígonos que no se
+        solapan, como límites administrativos: CoverageUnion de GEOS, mucho
+        más rápido) o 'auto' (usa 'coverage' si la capa es una cobertura válida)
+        """
+        if method == 'auto':
+            method = 'coverage' if is_coverage(gdf) else 'unary'
+        
         if by:
-            return gdf.dissolve(by=by, aggfunc=aggfunc)
-        return gdf.dissolve(aggfunc=aggfunc)
+            groups = gdf.groupby(by, sort=False).ngroup().to_numpy()
+            parts = run_partitioned(gdf, n_partitions,
+                                    lambda part: part.dissolve(by=by, aggfunc=aggfunc, method=method),
+                                    labels=groups)
+            if parts is not None:
+                return pd.concat(parts).sort_index()
+            return gdf.dissolve(by=by, aggfunc=aggfunc, method=method)
+        return gdf.dissolve(aggfunc=aggfunc, method=method)
     
     @staticmethod
     def centroid(gdf: gpd.GeoDataFrame) -> gpd.GeoDataFrame:
         """Calcula centroides"""
-        result = gdf.copy()
-        result['geometry'] = result.geometry.centroid
-        return result
+        return with_geometry(gdf, shapely.centroid(gdf.geometry.to_numpy()))
     
     @staticmethod
     def convex_hull(gdf: gpd.GeoDataFrame) -> gpd.GeoDataFrame:
         """Calcula envolvente convexa"""
-        result = gdf.copy()
-        result['geometry'] = result.geometry.convex_hull
-        return result
+        return with_geometry(gdf, shapely.convex_hull(gdf.geometry.to_numpy()))
     
     @staticmethod
     def calculate_area(gdf: gpd.GeoDataFrame, column_name: str = 'area_m2') -> gpd.GeoDataFrame:
         """Calcula área en metros cuadrados"""
-        result = gdf.copy()
+        result = result_copy(gdf)
         # Reproyectar a sistema métrico si es necesario
         if result.crs and result.crs.is_geographic:
-            result_proj = result.to_crs(result.estimate_utm_crs())
-            result[column_name] = result_proj.geometry.area
+            result[column_name] = GeoProcessingTools.metric_geometry(gdf).area
         else:
             result[column_name] = result.geometry.area
         return result
     
     @staticmethod
     def spatial_join(gdf1: gpd.GeoDataFrame, gdf2: gpd.GeoDataFrame, 
-                     how: str = 'inner', predicate: str = 'intersects') -> gpd.GeoDataFrame:
-        """Join espacial entre capas"""
+                     how: str = 'inner', predicate: str = 'intersects',
+                     n_partitions: Optional[int] = None) -> gpd.GeoDataFrame:
+        """Join espacial entre capas (n_partitions: bloques de gdf1 en paralelo)"""
+        if how in ('inner', 'left'):
+            parts = run_partitioned(gdf1, n_partitions,
+                                    lambda part: gpd.sjoin(part, gdf2, how=how, predicate=predicate))
+            if parts is not None:
+                return pd.concat(parts)
         return gpd.sjoin(gdf1, gdf2, how=how, predicate=predicate)
     
     @staticmethod
@@ -282,7 +756,8 @@ class GeoProcessingTools:
                    column: str = None,
                    cmap: str = 'viridis',
                    style: str = 'default',
-                   tiles: str = 'OpenStreetMap') -> folium.Map:
+                   tiles: str = 'OpenStreetMap',
+                   simplify_tolerance: Optional[float] = None) -> folium.Map:
         """
         Crea un mapa interactivo con Folium.
         
@@ -292,13 +767,19 @@ class GeoProcessingTools:
             cmap: Paleta de colores
             style: Estilo del mapa
             tiles: Proveedor de tiles
+            simplify_tolerance: Tolerancia en grados para simplificar las
+                geometrías (por defecto, la extensión / MAP_SIMPLIFY_PIXELS;
+                0 las envía completas)
         """
-        # Asegurar CRS WGS84
+        # Asegurar CRS WGS84 (la reproyección se memoriza por capa: volver a
+        # dibujar la misma capa no la repite)
         if gdf.crs and gdf.crs != 'EPSG:4326':
-            gdf = gdf.to_crs('EPSG:4326')
+            gdf = with_geometry(gdf, GeoProcessingTools.projected_geometry(gdf, 'EPSG:4326'))
         
-        # Calcular centro y bounds
+        # Calcular centro y bounds (una capa vacía no tiene extensión)
         bounds = gdf.total_bounds
+        if not np.isfinite(bounds).all():
+            return folium.Map(location=[0, 0], zoom_start=2, tiles=tiles)
         center = [(bounds[1] + bounds[3]) / 2, (bounds[0] + bounds[2]) / 2]
         
         # Crear mapa base
@@ -307,13 +788,26 @@ class GeoProcessingTools:
         # Ajustar zoom a bounds
         m.fit_bounds([[bounds[1], bounds[0]], [bounds[3], bounds[2]]])
         
+        # Simplificar solo para visualizar: a la escala del mapa los vértices
+        # sub-píxel no se ven pero inflan el GeoJSON y el render de Leaflet
+        if simplify_tolerance is None:
+            simplify_tolerance = max(bounds[2] - bounds[0], bounds[3] - bounds[1]) / MAP_SIMPLIFY_PIXELS
+        if simplify_tolerance > 0:
+            gdf = with_geometry(gdf, shapely.simplify(
+                gdf.geometry.array, simplify_tolerance, preserve_topology=False
+            ))
+        
+        # GeoJSON serializado una sola vez (sin bbox por elemento, a diferencia
+        # de __geo_interface__); los "id" de los features son el índice como texto
+        geo_json = gdf.to_json()
+        
         # Agregar capa
         if column and column in gdf.columns:
             # Mapa coroplético
             folium.Choropleth(
-                geo_data=gdf.__geo_interface__,
-                data=gdf,
-                columns=[gdf.index.name or 'index', column],
+                geo_data=geo_json,
+                data=pd.DataFrame({'id': gdf.index.astype(str), column: gdf[column].to_numpy()}),
+                columns=['id', column],
                 key_on='feature.id',
                 fill_color=cmap,
                 fill_opacity=0.7,
@@ -323,7 +817,7 @@ class GeoProcessingTools:
         else:
             # Mapa simple
             folium.GeoJson(
-                gdf,
+                geo_json,
                 style_function=lambda x: {
                     'fillColor': '#3388ff',
                     'color': '#000000',
@@ -335,31 +829,28 @@ class GeoProcessingTools:
         return m
 
 
-def generate_geoprocessing_code(operation: str, params: Dict[str, Any]) -> str:
-    """
-    Genera código Python para operaciones de geoprocesamiento.
-    Útil para que el chat genere código ejecutable.
-    """
-    templates = {
-        'buffer': '''
-# Buffer de {distance} metros a la capa {layer}
-resultado = capas['{layer}'].copy()
+# Plantillas de código para el chat, compiladas una vez al importar. Con
+# string.Template las llaves del código no se escapan: solo $nombre se sustituye
+GEOPROCESSING_TEMPLATES = {
+    'buffer': Template('''
+# Buffer de $distance metros a la capa $layer
+resultado = capas['$layer'].copy()
 if resultado.crs.is_geographic:
     resultado = resultado.to_crs(resultado.estimate_utm_crs())
-resultado['geometry'] = resultado.geometry.buffer({distance})
+resultado['geometry'] = resultado.geometry.buffer($distance)
 resultado = resultado.to_crs('EPSG:4326')
-print(f"Buffer creado: {{len(resultado)}} elementos")
-''',
-        'intersection': '''
-# Intersección entre {layer1} y {layer2}
-capa1 = capas['{layer1}']
-capa2 = capas['{layer2}']
+print(f"Buffer creado: {len(resultado)} elementos")
+'''),
+    'intersection': Template('''
+# Intersección entre $layer1 y $layer2
+capa1 = capas['$layer1']
+capa2 = capas['$layer2']
 resultado = gpd.overlay(capa1, capa2, how='intersection')
-print(f"Intersección: {{len(resultado)}} elementos resultantes")
-''',
-        'area': '''
-# Calcular área de {layer}
-resultado = capas['{layer}'].copy()
+print(f"Intersección: {len(resultado)} elementos resultantes")
+'''),
+    'area': Template('''
+# Calcular área de $layer
+resultado = capas['$layer'].copy()
 if resultado.crs.is_geographic:
     resultado_proj = resultado.to_crs(resultado.estimate_utm_crs())
     resultado['area_m2'] = resultado_proj.geometry.area
@@ -367,35 +858,46 @@ if resultado.crs.is_geographic:
 else:
     resultado['area_m2'] = resultado.geometry.area
     resultado['area_ha'] = resultado['area_m2'] / 10000
-print(f"Área total: {{resultado['area_ha'].sum():.2f}} hectáreas")
-''',
-        'map': '''
-# Crear mapa de {layer}
-capa = capas['{layer}']
+print(f"Área total: {resultado['area_ha'].sum():.2f} hectáreas")
+'''),
+    'map': Template('''
+# Crear mapa de $layer
+capa = capas['$layer']
 if capa.crs != 'EPSG:4326':
     capa = capa.to_crs('EPSG:4326')
 
 bounds = capa.total_bounds
 center = [(bounds[1] + bounds[3]) / 2, (bounds[0] + bounds[2]) / 2]
 
-mapa = folium.Map(location=center, tiles='{tiles}')
+mapa = folium.Map(location=center, tiles='$tiles')
 mapa.fit_bounds([[bounds[1], bounds[0]], [bounds[3], bounds[2]]])
 
 folium.GeoJson(
     capa,
-    style_function=lambda x: {{
-        'fillColor': '{color}',
+    style_function=lambda x: {
+        'fillColor': '$color',
         'color': '#000000',
         'weight': 1,
         'fillOpacity': 0.6
-    }}
+    }
 ).add_to(mapa)
 
 resultado = mapa
-'''
-    }
-    
-    if operation in templates:
-        return templates[operation].format(**params)
+'''),
+}
+
+
+def generate_geoprocessing_code(operation: str, params: Dict[str, Any]) -> str:
+    """
+    Genera código Python para operaciones de geoprocesamiento.
+    Útil para que el chat genere código ejecutable.
+    """
+    template = GEOPROCESSING_TEMPLATES.get(operation)
+    if template is not None:
+        return template.substitute(params)
     
     return f"# Operación '{operation}' no reconocida"
+
+
+if __name__ == "__main__":
+    isolated_main(int(sys.argv[1]))
@@ -0,0 +1,53 @@
+"""
+GeoIA Territorial v3.0 - Lectura de Capas
+==========================================
+Lectura de archivos de capa compartida por el store (caché por proceso) y por
+el proceso aislado de ejecución de código, que lee solo las capas que usa.
+"""
+
+from collections.abc import Mapping
+from typing import Dict
+
+
+def read_layer(path: str):
+    """Lee una capa con pyogrio (por la interfaz Arrow si hay pyarrow)"""
+    import geopandas as gpd
+    
+    # Con pyarrow, pyogrio lee por la interfaz Arrow de GDAL: en bloque por
+    # columnas, ~2x más rápido y con los mismos dtypes que la lectura por filas
+    try:
+        import pyarrow  # noqa: F401
+        use_arrow = True
+    except ImportError:
+        use_arrow = False
+    
+    return gpd.read_file(path, engine="pyogrio", use_arrow=use_arrow)
+
+
+class LayerFiles(Mapping):
+    """
+    Capas {nombre: GeoDataFrame} que se leen del disco la primera vez que se
+    piden. Se serializa solo con las rutas: al proceso aislado no viajan las
+    geometrías, y allí se lee únicamente lo que el código toca.
+    """
+    
+    def __init__(self, paths: Dict[str, str]):
+        self._paths = dict(paths)
+        self._loaded = {}
+    
+    def __getitem__(self, name: str):
+        if name not in self._loaded:
+            self._loaded[name] = read_layer(self._paths[name])
+        return self._loaded[name]
+    
+    def __iter__(self):
+        return iter(self._paths)
+    
+    def __len__(self) -> int:
+        return len(self._paths)
+    
+    def __repr__(self) -> str:
+        return f"LayerFiles({list(self._paths)})"
+    
+    def __reduce__(self):
+        return LayerFiles, (self._paths,)
@@ -0,0 +1,117 @@
+"""
+GeoIA Territorial v3.0 - Caché de Escaneo
+==========================================
+Guarda los metadatos de las capas de una base de conocimiento en la caché del
+usuario, para que reconectar o re-escanear solo analice los archivos que
+cambiaron. Nada se escribe dentro de la carpeta de datos.
+"""
+
+import hashlib
+import json
+import os
+import tempfile
+from pathlib import Path
+from typing import Dict, Any
+
+
+# Archivo que versiones anteriores dejaban en la carpeta de datos; ya no se
+# escribe, pero se sigue ignorando al escanear
+CACHE_FILE = ".geoia_cache.json"
+CACHE_VERSION = 3
+
+# Hasta este tamaño la huella es el SHA-256 del contenido: sobrevive a copias
+# y checkouts que solo cambian el mtime. Los archivos mayores usan tamaño+mtime
+HASH_MAX_BYTES = 1024 * 1024
+
+# Archivos compañeros de un shapefile que también cambian sus metadatos
+SHAPEFILE_SIDECARS = ('.shx', '.dbf', '.prj', '.cpg')
+
+
+def layer_files(file: Path) -> list:
+    """Archivos que forman una capa: el principal y, en shapefiles, sus compañeros"""
+    files = [file]
+    if file.suffix.lower() == '.shp':
+        files += [file.with_suffix(ext) for ext in SHAPEFILE_SIDECARS]
+    return files
+
+
+def file_version(file: Path) -> tuple:
+    """
+    Versión barata de una capa para claves de caché en memoria: (tamaño, mtime)
+    de cada archivo de la capa, None si falta. Solo hace stat, sin leer contenido.
+    """
+    version = []
+    for f in layer_files(file):
+        try:
+            stat = f.stat()
+            version.append((stat.st_size, stat.st_mtime_ns))
+        except OSError:
+            version.append(None)
+    return tuple(version)
+
+
+def file_fingerprint(file: Path) -> list:
+    """
+    Huella de un archivo de capa. En shapefiles incluye los archivos
+    compañeros: un .dbf o .prj editado también invalida la entrada.
+    """
+    fingerprint = []
+    for f in layer_files(file):
+        try:
+            stat = f.stat()
+            fingerprint.append(_fingerprint(f, stat.st_size, stat.st_mtime_ns))
+        except OSError:
+            fingerprint.append(None)
+    return fingerprint
+
+
+def _fingerprint(path: Path, size: int, mtime_ns: int) -> str:
+    """Hash del contenido para archivos pequeños; tamaño y mtime para los grandes"""
+    if size > HASH_MAX_BYTES:
+        return f"{size}:{mtime_ns}"
+
+    with open(path, 'rb') as f:
+        return hashlib.file_digest(f, 'sha256').hexdigest()
+
+
+def cache_path(root: Path) -> Path:
+    """Archivo de caché de una carpeta: uno por ruta, en el directorio de caché del usuario"""
+    base = os.environ.get('XDG_CACHE_HOME') or os.environ.get('LOCALAPPDATA') or Path.home() / '.cache'
+    digest = hashlib.sha256(str(root.resolve()).encode('utf-8')).hexdigest()[:32]
+    return Path(base) / 'geoia-territorial' / 'scan' / f"{digest}.json"
+
+
+def load_cache(root: Path) -> Dict[str, Any]:
+    """Entradas {ruta: {"fingerprint", "layer"}} guardadas; vacío si no hay caché válida"""
+    try:
+        data = json.loads(cache_path(root).read_text(encoding='utf-8'))
+    except (OSError, ValueError):
+        return {}
+
+    if not isinstance(data, dict) or data.get("version") != CACHE_VERSION:
+        return {}
+    return data.get("entries", {})
+
+
+def save_cache(root: Path, entries: Dict[str, Any]):
+    """
+    Guarda las entradas de forma atómica: se escribe un temporal y se renombra,
+    así dos sesiones que re-escanean a la vez o un corte a mitad de escritura
+    nunca dejan un archivo truncado. Si no se puede escribir, no se cachea.
+    """
+    path = cache_path(root)
+    try:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=path.parent, prefix=path.stem, suffix='.tmp')
+    except OSError:
+        return
+
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            json.dump({"version": CACHE_VERSION, "entries": entries}, f, ensure_ascii=False)
+        os.replace(tmp, path)
+    except OSError:
+        try:
+            os.unlink(tmp)
+        except OSError:
+            pass
@@ -0,0 +1,41 @@
+"""
+Pruebas de regresión del sandbox de CodeExecutionEngine.
+Ejecutar desde la raíz del repositorio: python -m unittest discover tests
+"""
+
+import unittest
+
+from core.execution_engine import CodeExecutionEngine
+
+
+class SandboxValidationTest(unittest.TestCase):
+    """Código que debe rechazarse antes de ejecutarse"""
+    
+    def setUp(self):
+        self.engine = CodeExecutionEngine({})
+    
+    def assertRejected(self, code: str):
+        is_valid, error = self.engine.validate_code(code)
+        self.assertFalse(is_valid, f"El código no se rechazó: {code}")
+        
+        result = self.engine.execute(code)
+        self.assertFalse(result["success"])
+        self.assertIn("Operación no permitida", result["error"])
+    
+    def test_os_through_pandas_module(self):
+        self.assertRejected("pd.io.common.os.system('echo PWNED')")
+    
+    def test_os_through_geopandas_module(self):
+        self.assertRejected("resultado = gpd.io.file.os.getcwd()")
+    
+    def test_os_through_getattr(self):
+        self.assertRejected("getattr(pd.io.common, 'os').system('echo PWNED')")
+    
+    def test_allowed_code_still_runs(self):
+        result = self.engine.execute("resultado = pd.DataFrame({'a': [1, 2]})['a'].sum()")
+        self.assertTrue(result["success"], result["error"])
+        self.assertEqual(result["result"], 3)
+
+
+if __name__ == "__main__":
+    unittest.main()